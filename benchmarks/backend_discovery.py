@@ -0,0 +1,94 @@
+"""Compare startup time of importing all backends with entry point discovery.
+
+Installs ``count`` fake backend packages, each taking ``delay`` seconds to
+import, into a temporary directory, and measures in fresh interpreters:
+
+* ``eager``: import every backend package, as needed to fill a plain ``dict``
+* ``lazy_unused``: discover backend labels through entry points, import none
+* ``lazy_one``: discover backend labels, and import the backend of one project
+
+Usage: ``python benchmarks/backend_discovery.py [count] [delay]``"""
+from pathlib import Path
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import emit
+
+GROUP = "bw_projects.backends"
+
+SCRIPTS = {
+    "eager": """
+import bw_projects, importlib
+for i in range({count}):
+    module = importlib.import_module("fake_backend_{{}}".format(i))
+    bw_projects.backend_mapping["fake-{{}}".format(i)] = module.backend
+""",
+    "lazy_unused": """
+import bw_projects
+assert "fake-0" in bw_projects.backend_mapping
+""",
+    "lazy_one": """
+import bw_projects
+bw_projects.backend_mapping["fake-0"]
+""",
+}
+
+TIMER = """
+import time
+start = time.perf_counter()
+{script}
+print(time.perf_counter() - start)
+"""
+
+
+def install(root, count, delay):
+    dist_info = root / "fake_backends-1.0.dist-info"
+    dist_info.mkdir()
+    (dist_info / "METADATA").write_text(
+        "Metadata-Version: 2.1\nName: fake-backends\nVersion: 1.0\n"
+    )
+    lines = ["[{}]".format(GROUP)]
+    for i in range(count):
+        (root / "fake_backend_{}.py".format(i)).write_text(
+            "import time\ntime.sleep({})\nbackend = object()\n".format(delay)
+        )
+        lines.append("fake-{0} = fake_backend_{0}:backend".format(i))
+    (dist_info / "entry_points.txt").write_text("\n".join(lines) + "\n")
+
+
+def measure(count=20, delay=0.05, repeat=3):
+    package_root = Path(__file__).parent.parent
+    with tempfile.TemporaryDirectory() as td:
+        install(Path(td), count, delay)
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([td, str(package_root)]),
+            BRIGHTWAY_DIR=td,
+        )
+        for label, script in SCRIPTS.items():
+            code = TIMER.format(script=script.format(count=count))
+            timings = []
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, "-c", code],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                timings.append(float(output.split()[-1]))
+            emit(
+                "backend_startup_" + label,
+                seconds=min(timings),
+                backends=count,
+                import_delay=delay,
+            )
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    measure(count, delay)
@@ -0,0 +1,50 @@
+"""Compare ``filesystem.copy_tree`` with ``shutil.copytree``.
+
+Usage: ``python benchmarks/copy_project.py [files] [file size in MB]``"""
+from pathlib import Path
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import emit, timer
+from bw_projects.filesystem import copy_tree
+
+
+def make_tree(root, files, size):
+    for i in range(files):
+        subdir = root / "dir-{}".format(i % 10)
+        subdir.mkdir(parents=True, exist_ok=True)
+        with open(subdir / "file-{}".format(i), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def measure(files=100, size_mb=4):
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        make_tree(td / "source", files, int(size_mb * 1e6))
+        with timer() as t:
+            shutil.copytree(td / "source", td / "copytree")
+        emit("shutil.copytree", seconds=t["seconds"], files=files, size_mb=size_mb)
+        with timer() as t:
+            counts = copy_tree(td / "source", td / "copy_tree")
+        emit("copy_tree", seconds=t["seconds"], files=files, size_mb=size_mb, **counts)
+        for path in (td / "source").rglob("*"):
+            if path.is_file():
+                path.chmod(0o444)
+        with timer() as t:
+            counts = copy_tree(td / "source", td / "copy_tree_immutable")
+        emit(
+            "copy_tree_immutable",
+            seconds=t["seconds"],
+            files=files,
+            size_mb=size_mb,
+            **counts
+        )
+
+
+if __name__ == "__main__":
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    size_mb = float(sys.argv[2]) if len(sys.argv) > 2 else 4
+    measure(files, size_mb)
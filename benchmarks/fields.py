@@ -0,0 +1,106 @@
+"""Encode/decode throughput of ``JSONField`` and ``TupleField`` codecs, and the
+cost of reading rows with eager and lazy decoding.
+
+Usage: ``python benchmarks/fields.py [rows]``"""
+from pathlib import Path
+import sys
+import uuid
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import best_of, emit
+from bw_projects.peewee import (
+    JSONCodec,
+    JSONField,
+    PackedCodec,
+    SubstitutableDatabase,
+    TupleField,
+)
+from peewee import Model, TextField
+
+SHAPES = {
+    "project_data": {
+        "owner": "scenario-team",
+        "region": "CH",
+        "tags": ["ssp2", "2050", "baseline"],
+        "created": 1571234567.123,
+    },
+    "backends": ["default", "bw2data", "bw_processing"],
+    "key": ("ecoinvent 3.8 cutoff", uuid.uuid4().hex),
+    "exchange": (
+        "ecoinvent 3.8 cutoff",
+        uuid.uuid4().hex,
+        0.123456789,
+        "kilogram",
+        True,
+    ),
+}
+
+CODECS = {
+    "json": JSONCodec(ensure_ascii=False),
+    "packed": PackedCodec(),
+}
+
+
+def measure_codecs(count):
+    for shape, value in SHAPES.items():
+        for name, codec in CODECS.items():
+            encoded = codec.encode(value)
+            encode = best_of(lambda: [codec.encode(value) for _ in range(count)])
+            decode = best_of(lambda: [codec.decode(encoded) for _ in range(count)])
+            emit(
+                "codec_encode",
+                codec=name,
+                shape=shape,
+                bytes=len(encoded),
+                values_per_second=count / encode,
+            )
+            emit(
+                "codec_decode",
+                codec=name,
+                shape=shape,
+                bytes=len(encoded),
+                values_per_second=count / decode,
+            )
+
+
+def measure_rows(count):
+    for lazy in (False, True):
+        for codec_name, codec in CODECS.items():
+
+            class Row(Model):
+                name = TextField()
+                data = JSONField(lazy=lazy)
+                key = TupleField(codec=codec, lazy=lazy)
+
+            db = SubstitutableDatabase(tables=[Row])
+            with db.atomic():
+                Row.insert_many(
+                    [
+                        {
+                            "name": str(i),
+                            "data": SHAPES["project_data"],
+                            "key": SHAPES["exchange"],
+                        }
+                        for i in range(count)
+                    ]
+                ).execute()
+            names_only = best_of(lambda: [row.name for row in Row.select()], 3)
+            all_fields = best_of(
+                lambda: [(row.data, row.key) for row in Row.select()], 3
+            )
+            timings = {"names_only": names_only, "all_fields": all_fields}
+            for label, seconds in timings.items():
+                emit(
+                    "read_rows",
+                    access=label,
+                    lazy=lazy,
+                    tuple_codec=codec_name,
+                    rows_per_second=count / seconds,
+                )
+            db.close()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    measure_codecs(count)
+    measure_rows(count)
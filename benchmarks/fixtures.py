@@ -0,0 +1,75 @@
+"""Compare the run time of a test suite using ``testing.bwtest`` with the same
+suite using ``testing.bwtest_fast``.
+
+Generated tests either only check that there are no projects (``empty``, to
+measure the fixtures themselves), or create two projects, select one and delete
+the other (``lifecycle``).
+
+Usage: ``python benchmarks/fixtures.py [tests]``"""
+from pathlib import Path
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import emit, timer
+
+TEMPLATE = """
+from bw_projects import projects
+from bw_projects.testing import bwtest, bwtest_fast, bwtest_session
+import pytest
+
+
+@pytest.mark.parametrize("i", range({tests}))
+def test_projects({fixture}, i):
+{body}
+"""
+
+BODIES = {
+    "empty": """
+    assert not len(projects)
+""",
+    "lifecycle": """
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    projects.select("bar")
+    projects.delete_project("foo")
+    assert len(projects) == 1
+""",
+}
+
+
+def measure(tests=500):
+    root = Path(__file__).parent.parent
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "pytest.ini").write_text("[pytest]\n")
+        env = dict(os.environ, BRIGHTWAY_DIR=str(td), PYTHONPATH=str(root))
+        for workload, body in BODIES.items():
+            for fixture in ("bwtest", "bwtest_fast"):
+                filepath = td / "test_{}_{}.py".format(workload, fixture)
+                filepath.write_text(
+                    TEMPLATE.format(tests=tests, fixture=fixture, body=body.strip("\n"))
+                )
+                with timer() as t:
+                    subprocess.run(
+                        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider"]
+                        + [str(filepath)],
+                        cwd=td,
+                        env=env,
+                        check=True,
+                        capture_output=True,
+                    )
+                emit(
+                    "test_fixture",
+                    fixture=fixture,
+                    workload=workload,
+                    tests=tests,
+                    seconds=t["seconds"],
+                    seconds_per_test=t["seconds"] / tests,
+                )
+
+
+if __name__ == "__main__":
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
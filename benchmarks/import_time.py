@@ -0,0 +1,48 @@
+"""Time ``import bw_projects`` and the first use of ``bw_projects.projects``.
+
+Each measurement runs in a fresh interpreter against a temporary ``BRIGHTWAY_DIR``.
+
+Usage: ``python benchmarks/import_time.py [repeat]``"""
+from pathlib import Path
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import emit
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import bw_projects
+imported = time.perf_counter()
+bw_projects.projects
+used = time.perf_counter()
+print(imported - start, used - imported)
+"""
+
+
+def measure(repeat=10):
+    import_times, first_use_times = [], []
+    root = Path(__file__).parent.parent
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as td:
+            env = dict(os.environ, BRIGHTWAY_DIR=td)
+            output = subprocess.run(
+                [sys.executable, "-c", SCRIPT],
+                env=env,
+                cwd=root,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            imported, used = map(float, output.split()[-2:])
+            import_times.append(imported)
+            first_use_times.append(used)
+    emit("import", seconds=min(import_times), repeat=repeat)
+    emit("first_use", seconds=min(first_use_times), repeat=repeat)
+
+
+if __name__ == "__main__":
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,43 @@
+"""Per-call overhead of ``metrics.timed`` and ``metrics.span``, disabled and
+enabled with a ``MemorySink``.
+
+Usage: ``python benchmarks/metrics.py [calls]``"""
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import best_of, emit
+from bw_projects import metrics
+
+
+def noop():
+    pass
+
+
+timed_noop = metrics.timed("noop")(noop)
+
+
+def with_span():
+    with metrics.span("noop"):
+        pass
+
+
+def measure(calls):
+    baseline = best_of(lambda: [noop() for _ in range(calls)])
+    for state in ("disabled", "enabled"):
+        if state == "enabled":
+            metrics.enable()
+        for name, func in (("timed", timed_noop), ("span", with_span)):
+            seconds = best_of(lambda: [func() for _ in range(calls)])
+            emit(
+                "metrics_overhead",
+                instrumentation=name,
+                state=state,
+                calls=calls,
+                overhead_ns_per_call=(seconds - baseline) / calls * 1e9,
+            )
+    metrics.disable()
+
+
+if __name__ == "__main__":
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
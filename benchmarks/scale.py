@@ -0,0 +1,165 @@
+"""Time the core ``ProjectManager`` operations on synthetic installations.
+
+For each installation size, a temporary base directory is filled with
+``projects`` projects (created with ``create_projects``), each with ``files``
+files of ``file_size`` bytes spread over subdirectories of 1000 files. Then:
+
+* ``import``: ``import bw_projects`` and first use of ``projects``, with
+  ``len(projects)``, in a fresh interpreter;
+* ``len``, ``contains``, ``iterate`` and ``repr``, with a cold and a warm catalog;
+* ``select``: switching between projects, with ``FakeBackend`` hook ``latency``;
+* ``create_project`` and ``delete_project``;
+* ``report``: a full rescan, then with the directory size index;
+* JSONField and TupleField codecs, see ``fields.py``.
+
+Each result is one line of JSON on stdout, including the ``bw_projects``
+version, so runs of different releases can be compared.
+
+Usage: ``python benchmarks/scale.py [--projects 10,1000,50000] [--files 0]
+[--file-size 100] [--latency 0] [--repeat 5]``"""
+from pathlib import Path
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent))
+from utils import best_of, emit, timer
+from bw_projects import backend_mapping, Project, ProjectManager
+from bw_projects.peewee import SubstitutableDatabase
+from bw_projects.testing import FakeBackend
+import fields
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import bw_projects
+len(bw_projects.projects)
+print(time.perf_counter() - start)
+"""
+
+
+def make_installation(base_dir, count, files, file_size):
+    """Create ``count`` projects in ``base_dir``, each with ``files`` files."""
+    manager = ProjectManager(base_dir, base_dir / "logs")
+    names = ["project-{:06d}".format(i) for i in range(count)]
+    failures = manager.create_projects(
+        [{"name": name, "backends": ["bench"]} for name in names]
+    )
+    if failures:
+        raise RuntimeError(failures)
+    content = b"x" * file_size
+    for obj in Project.select():
+        for i in range(files):
+            subdir = obj.directory / "dir-{}".format(i // 1000)
+            if not i % 1000:
+                subdir.mkdir()
+            with open(subdir / "file-{}".format(i), "wb") as f:
+                f.write(content)
+    return manager, names
+
+
+def measure_import(base_dir, repeat, **labels):
+    timings = []
+    for _ in range(repeat):
+        env = dict(os.environ, BRIGHTWAY_DIR=str(base_dir))
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timings.append(float(output.split()[-1]))
+    emit("import", seconds=min(timings), **labels)
+
+
+def measure_catalog(manager, names, repeat, **labels):
+    def cold(func):
+        def wrapper():
+            manager._cache = None
+            func()
+
+        return wrapper
+
+    operations = {
+        "len": lambda: len(manager),
+        "contains": lambda: names[-1] in manager,
+        "iterate": lambda: list(manager),
+        "repr": lambda: repr(manager),
+    }
+    for operation, func in operations.items():
+        emit(operation, cache="cold", seconds=best_of(cold(func), repeat), **labels)
+        emit(operation, cache="warm", seconds=best_of(func, repeat), **labels)
+
+
+def measure_select(manager, names, repeat, **labels):
+    targets = [names[0], names[-1]] * repeat
+    manager.select(names[len(names) // 2])
+    with timer() as t:
+        for name in targets:
+            manager.select(name)
+    emit("select", seconds=t["seconds"] / len(targets), **labels)
+
+
+def measure_create_delete(manager, repeat, **labels):
+    new_names = ["new-project-{}".format(i) for i in range(repeat)]
+    with timer() as t:
+        for name in new_names:
+            manager.create_project(name, backends=["bench"], switch=False)
+    emit("create_project", seconds=t["seconds"] / repeat, **labels)
+    with timer() as t:
+        for name in new_names:
+            manager.delete_project(name)
+    emit("delete_project", seconds=t["seconds"] / repeat, **labels)
+    manager.purge_trash()
+
+
+def measure_report(manager, **labels):
+    with timer() as t:
+        manager.report(refresh=True)
+    emit("report", index="refresh", seconds=t["seconds"], **labels)
+    with timer() as t:
+        manager.report()
+    emit("report", index="warm", seconds=t["seconds"], **labels)
+
+
+def measure(sizes, files, file_size, latency, repeat):
+    backend_mapping["bench"] = FakeBackend(latency)
+    for count in sizes:
+        labels = {"projects": count, "files": files, "file_size": file_size}
+        with tempfile.TemporaryDirectory() as td:
+            base_dir = Path(td)
+            database = SubstitutableDatabase(base_dir / "projects.db", [Project])
+            with timer() as t:
+                manager, names = make_installation(base_dir, count, files, file_size)
+            emit("make_installation", seconds=t["seconds"], **labels)
+            database.close()
+            measure_import(base_dir, repeat, **labels)
+
+            database = SubstitutableDatabase(base_dir / "projects.db", [Project])
+            measure_catalog(manager, names, repeat, **labels)
+            measure_select(manager, names, repeat, latency=latency, **labels)
+            measure_create_delete(manager, repeat, **labels)
+            measure_report(manager, **labels)
+            manager.deactivate()
+            database.close()
+    fields.measure_codecs(10000)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--projects", default="10,1000,10000,50000")
+    parser.add_argument("--files", type=int, default=0)
+    parser.add_argument("--file-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    measure(
+        [int(size) for size in args.projects.split(",")],
+        args.files,
+        args.file_size,
+        args.latency,
+        args.repeat,
+    )
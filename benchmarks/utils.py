@@ -0,0 +1,36 @@
+from bw_projects import __version__
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+
+@contextmanager
+def timer():
+    """Time the enclosed block.
+
+    Yields a dictionary; its ``seconds`` key is set when the block exits."""
+    result = {}
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result["seconds"] = time.perf_counter() - start
+
+
+def best_of(func, repeat=5):
+    """Return the fastest of ``repeat`` timings of ``func()``, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        with timer() as t:
+            func()
+        timings.append(t["seconds"])
+    return min(timings)
+
+
+def emit(benchmark, **values):
+    """Write one benchmark result as a line of JSON to stdout."""
+    values["benchmark"] = benchmark
+    values["version"] = ".".join(map(str, __version__))
+    print(json.dumps(values, sort_keys=True))
+    sys.stdout.flush()
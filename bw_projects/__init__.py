@@ -10,17 +10,69 @@ __all__ = [
 ]
 
 
+import os
+import threading
+
+from .backends import BackendRegistry
 from .peewee import JSONField, PathField, SubstitutableDatabase, TupleField
 
-backend_mapping = {}
+backend_mapping = BackendRegistry()
+
+from .projects import Project, ProjectManager
 
-from .base_dir import get_base_directories
+# The ``projects`` submodule shadows the lazily created ``projects`` manager
+del projects
 
-_BASE_DIR, _BASE_LOG_DIR = get_base_directories()
+_setup_lock = threading.Lock()
 
-from .projects import Project, ProjectManager
 
-_BASE_DIR.mkdir(parents=True, exist_ok=True)
-project_database = SubstitutableDatabase(_BASE_DIR / "projects.db", [Project])
+def _env_flag(name):
+    return os.getenv(name, "").lower() not in ("", "0", "false", "no")
+
+
+def _setup():
+    """Resolve the base directories, open the project catalog, and create the
+    project manager.
+
+    Called on first access of ``projects`` or ``project_database``, so that
+    importing ``bw_projects`` doesn't touch the filesystem or SQLite.
+
+    Set the environment variable ``BRIGHTWAY_CONCURRENT`` to open the catalog
+    for concurrent use by many processes, and ``BRIGHTWAY_METRICS`` to record
+    timings and counters in an in-memory ``metrics.MemorySink``.
+
+    Set ``BRIGHTWAY_READONLY`` to open an existing catalog read-only, without
+    creating any tables or directories, e.g. in worker processes. With
+    ``BRIGHTWAY_IMMUTABLE``, SQLite also skips locking, which is only safe if
+    no other process modifies the catalog meanwhile."""
+    global project_database, projects
+
+    from . import metrics
+    from .base_dir import get_base_directories
+
+    if _env_flag("BRIGHTWAY_METRICS"):
+        metrics.enable()
+
+    immutable = _env_flag("BRIGHTWAY_IMMUTABLE")
+    readonly = immutable or _env_flag("BRIGHTWAY_READONLY")
+    base_dir, base_log_dir = get_base_directories(create=not readonly)
+    if not readonly:
+        base_dir.mkdir(parents=True, exist_ok=True)
+    project_database = SubstitutableDatabase(
+        base_dir / "projects.db",
+        [Project],
+        concurrent=_env_flag("BRIGHTWAY_CONCURRENT"),
+        readonly=readonly,
+        immutable=immutable,
+        query_metric="catalog.queries",
+    )
+    projects = ProjectManager(base_dir, base_log_dir, readonly=readonly)
+
 
-projects = ProjectManager(_BASE_DIR, _BASE_LOG_DIR)
+def __getattr__(name):
+    if name in ("projects", "project_database"):
+        with _setup_lock:
+            if name not in globals():
+                _setup()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,162 @@
+from .filesystem import HashManifest
+from pathlib import Path, PurePosixPath
+import io
+import json
+import os
+import shutil
+import tarfile
+
+ARCHIVE_FORMAT = 1
+COMPRESSIONS = ("", "gz", "bz2", "xz")
+METADATA = "project.json"
+FILES = "files"
+
+
+def manifest_path(filepath):
+    """Path of the manifest written next to the archive at ``filepath``."""
+    filepath = Path(filepath)
+    return filepath.with_name(filepath.name + ".manifest.json")
+
+
+def read_manifest(filepath):
+    """Read the manifest of the archive at ``filepath``.
+
+    Returns ``{relative path: [inode, size, mtime_ns]}``."""
+    with open(manifest_path(filepath), encoding="utf-8") as f:
+        return json.load(f)["files"]
+
+
+def write_archive(
+    filepath, directory, metadata, compression="gz", since=None, ignore=()
+):
+    """Stream ``directory`` and project ``metadata`` into a tar archive at ``filepath``.
+
+    Files are read directly from ``directory``; nothing is staged on disk.
+    ``compression`` is one of ``COMPRESSIONS``.
+
+    If ``since`` is the path of a previous archive of the same directory, only
+    files changed since then (according to its manifest) are written, together
+    with a list of deleted files. In all cases a manifest of the current files
+    is written next to the archive, for later differential archives.
+
+    Returns the number of files written."""
+    compression = compression or ""
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            "Compression must be one of {}".format(", ".join(map(repr, COMPRESSIONS)))
+        )
+    directory = Path(directory)
+    # A project without a directory is exported without files
+    current = {}
+    if directory.is_dir():
+        current = HashManifest.scan(directory, ignore, symlinks=True)
+    previous = read_manifest(since) if since else {}
+    changed = sorted(
+        relpath
+        for relpath, key in current.items()
+        if tuple(previous.get(relpath, ())) != key
+    )
+    metadata = dict(
+        metadata,
+        format=ARCHIVE_FORMAT,
+        differential=bool(since),
+        deleted=sorted(set(previous).difference(current)),
+    )
+
+    # Stream mode gzip needs a string filename
+    with tarfile.open(os.fspath(filepath), "w|" + compression) as tar:
+        encoded = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        info = tarfile.TarInfo(METADATA)
+        info.size = len(encoded)
+        tar.addfile(info, io.BytesIO(encoded))
+        for relpath in changed:
+            tar.add(
+                directory / relpath,
+                arcname="{}/{}".format(FILES, relpath),
+                recursive=False,
+            )
+
+    with open(manifest_path(filepath), "w", encoding="utf-8") as f:
+        json.dump({"files": current}, f)
+    return len(changed)
+
+
+def _member_path(directory, name):
+    """Destination for archive member ``name``; refuse paths outside ``directory``,
+    including paths through symbolic links."""
+    path = PurePosixPath(name)
+    parts = path.parts
+    if path.is_absolute() or len(parts) < 2 or parts[0] != FILES or ".." in parts:
+        raise ValueError("Unsafe archive member: {}".format(name))
+    target = Path(directory)
+    for part in parts[1:-1]:
+        target = target / part
+        if target.is_symlink():
+            raise ValueError("Unsafe archive member: {}".format(name))
+    return target / parts[-1]
+
+
+def _replace(target):
+    """Prepare ``target`` to be written: create its directory, and remove an
+    existing file rather than overwrite it, as it could be a shared hard link."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.is_symlink() or target.exists():
+        target.unlink()
+
+
+def read_metadata(filepath):
+    """Read the project metadata from the archive at ``filepath``."""
+    with tarfile.open(os.fspath(filepath), "r|*") as tar:
+        member = tar.next()
+        if member is None or member.name != METADATA:
+            raise ValueError("{} is not a project archive".format(filepath))
+        return json.loads(tar.extractfile(member).read().decode("utf-8"))
+
+
+def extract_archive(filepath, directory):
+    """Stream the files of the archive at ``filepath`` into ``directory``.
+
+    For differential archives, files listed as deleted are removed from ``directory``.
+
+    Returns the project metadata."""
+    directory = Path(directory)
+    symlinks = []
+    with tarfile.open(os.fspath(filepath), "r|*") as tar:
+        metadata = None
+        for member in tar:
+            if metadata is None:
+                if member.name != METADATA:
+                    raise ValueError("{} is not a project archive".format(filepath))
+                metadata = json.loads(tar.extractfile(member).read().decode("utf-8"))
+                continue
+            if member.issym():
+                # Created last, so no file of this archive is written through them
+                symlinks.append(member)
+                continue
+            if not (member.isfile() or member.islnk()):
+                continue
+            target = _member_path(directory, member.name)
+            _replace(target)
+            if member.islnk():
+                # Files which shared an inode; the first was extracted before
+                source = _member_path(directory, member.linkname)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+                continue
+            with tar.extractfile(member) as source, open(target, "wb") as f:
+                shutil.copyfileobj(source, f)
+            os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+    for member in symlinks:
+        target = _member_path(directory, member.name)
+        _replace(target)
+        os.symlink(member.linkname, target)
+    if metadata is None:
+        raise ValueError("{} is not a project archive".format(filepath))
+    for relpath in metadata["deleted"]:
+        target = _member_path(directory, "{}/{}".format(FILES, relpath))
+        if target.is_symlink() or target.exists():
+            target.unlink()
+    return metadata
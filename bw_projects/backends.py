@@ -0,0 +1,129 @@
+import collections.abc
+import threading
+
+ENTRY_POINT_GROUP = "bw_projects.backends"
+
+
+def find_entry_points(group):
+    """Return the installed entry points in ``group``, without loading them."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            # Python 3.7
+            from importlib_metadata import entry_points
+        except ImportError:
+            import pkg_resources
+
+            return list(pkg_resources.iter_entry_points(group))
+    found = entry_points()
+    if hasattr(found, "select"):
+        return list(found.select(group=group))
+    return list(found.get(group, []))
+
+
+class BackendRegistry(collections.abc.MutableMapping):
+    """Mapping of backend labels to backends.
+
+    Backends can be registered directly (``backend_mapping[label] = backend``),
+    or advertised by installed packages as entry points in the
+    ``bw_projects.backends`` group, e.g. in ``setup.py``:
+
+    .. code-block:: python
+
+        entry_points={"bw_projects.backends": ["my_label = my_package:backend"]}
+
+    Entry points are discovered on first use without importing their packages.
+    A backend package is only imported when its backend is looked up, e.g.
+    when a project using it is activated, created or deleted, and the loaded
+    backend is then cached."""
+
+    def __init__(self, group=ENTRY_POINT_GROUP):
+        self.group = group
+        self._registered = {}
+        self._loaded = {}
+        self._entry_points = None
+        # Entry point labels deleted since the last ``refresh``
+        self._hidden = set()
+        self._lock = threading.RLock()
+
+    def _discover(self):
+        if self._entry_points is None:
+            with self._lock:
+                if self._entry_points is None:
+                    self._entry_points = {
+                        ep.name: ep for ep in find_entry_points(self.group)
+                    }
+        return self._entry_points
+
+    def _available(self):
+        """Labels of entry points which weren't deleted."""
+        return [label for label in self._discover() if label not in self._hidden]
+
+    def refresh(self):
+        """Discover entry points again, e.g. after installing a package.
+
+        Entry point backends deleted from the registry become available again."""
+        with self._lock:
+            self._entry_points = None
+            self._hidden = set()
+
+    def loaded(self):
+        """Return a dictionary of backends which are already imported."""
+        return dict(self._loaded, **self._registered)
+
+    def registered(self):
+        """Return the labels of backends set directly, not found as entry points."""
+        return list(self._registered)
+
+    def __getitem__(self, label):
+        try:
+            return self._registered[label]
+        except KeyError:
+            pass
+        try:
+            return self._loaded[label]
+        except KeyError:
+            pass
+        with self._lock:
+            if label in self._hidden:
+                raise KeyError(label)
+            if label not in self._loaded:
+                self._loaded[label] = self._discover()[label].load()
+            return self._loaded[label]
+
+    def __setitem__(self, label, backend):
+        with self._lock:
+            self._registered[label] = backend
+            self._hidden.discard(label)
+
+    def __delitem__(self, label):
+        """Remove ``label``. Installed entry points are only hidden, until
+        the next ``refresh``."""
+        with self._lock:
+            found = self._registered.pop(label, None) is not None
+            found = self._loaded.pop(label, None) is not None or found
+            if label in self._discover() and label not in self._hidden:
+                self._hidden.add(label)
+                found = True
+        if not found:
+            raise KeyError(label)
+
+    def __contains__(self, label):
+        return (
+            label in self._registered
+            or label in self._loaded
+            or (label in self._discover() and label not in self._hidden)
+        )
+
+    def __iter__(self):
+        labels = list(self._registered)
+        labels += [label for label in self._loaded if label not in labels]
+        labels += [label for label in self._available() if label not in labels]
+        return iter(labels)
+
+    def __len__(self):
+        return len(set(self._registered).union(self._loaded, self._available()))
+
+    def __repr__(self):
+        return "BackendRegistry with labels: {}".format(", ".join(sorted(self)))
@@ -4,7 +4,7 @@ import os
 import appdirs
 
 
-def get_base_directories():
+def get_base_directories(create=True):
     envvar = os.getenv("BRIGHTWAY_DIR")
     if envvar:
         envvar = Path(envvar).resolve()
@@ -20,7 +20,8 @@ def get_base_directories():
                 "directory:\n{}".format(envvar)
             )
             logs_dir = envvar / "logs"
-            logs_dir.mkdir(exist_ok=True)
+            if create:
+                logs_dir.mkdir(exist_ok=True)
             return envvar, logs_dir
 
     return (
@@ -0,0 +1,135 @@
+from .filesystem import hash_file, is_immutable, reflink
+from pathlib import Path
+import os
+import shutil
+import stat
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+class BlobStore:
+    """Content-addressed store for files shared between project directories.
+
+    Each distinct file content is stored once under ``root``, named by its
+    hash, and read-only.
+
+    Files which are already read-only (no write permission bits) are replaced
+    by hard links to their blob, so the filesystem link count of a blob is
+    its reference count plus one (for the store itself); blobs with a link
+    count of one are unused and are removed by ``collect``.
+
+    All other files could be modified in place by their backends, so they
+    are never hard linked, nor made read-only. Instead, where the filesystem
+    supports it, they are replaced by copy-on-write clones (reflinks) of
+    their blob, which share storage until either copy is modified. Otherwise
+    they are left alone."""
+
+    def __init__(self, root, algorithm="sha256"):
+        self.root = Path(root)
+        self.algorithm = algorithm
+
+    def exists(self):
+        return self.root.is_dir()
+
+    def path(self, digest):
+        return self.root / digest[:2] / digest
+
+    def digest(self, filepath):
+        return hash_file(filepath, self.algorithm)
+
+    def add(self, filepath, hardlink=None):
+        """Store ``filepath`` in the blob store, and replace it with a link to its blob.
+
+        If ``hardlink`` is ``None``, read-only files are hard linked and other
+        files reflinked, as described above. ``hardlink=True`` hard links
+        (and therefore makes read-only) a writable file, for callers who know
+        it is never modified in place.
+
+        Returns the number of bytes saved, which is zero if the content wasn't
+        already stored, ``filepath`` already is a hard link to its blob, or
+        reflinks aren't supported."""
+        filepath = Path(filepath)
+        if hardlink is None:
+            hardlink = is_immutable(filepath)
+        digest = self.digest(filepath)
+        blob = self.path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        if hardlink:
+            return self._hardlink(filepath, blob)
+        return self._reflink(filepath, blob)
+
+    def _hardlink(self, filepath, blob):
+        try:
+            os.link(filepath, blob)
+        except FileExistsError:
+            pass
+        else:
+            blob.chmod(READ_ONLY)
+            return 0
+        if os.path.samefile(filepath, blob):
+            return 0
+        size = filepath.stat().st_size
+        temp = filepath.with_name(".{}.bwlink".format(filepath.name))
+        os.link(blob, temp)
+        os.replace(temp, filepath)
+        return size
+
+    def _reflink(self, filepath, blob):
+        if not blob.exists():
+            temp = blob.with_name(".{}.bwlink".format(blob.name))
+            try:
+                reflink(filepath, temp)
+            except OSError:
+                # Not supported here; copying would only use more space
+                return 0
+            temp.chmod(READ_ONLY)
+            os.replace(temp, blob)
+            return 0
+        if os.path.samefile(filepath, blob):
+            return 0
+        size = filepath.stat().st_size
+        temp = filepath.with_name(".{}.bwlink".format(filepath.name))
+        try:
+            reflink(blob, temp)
+        except OSError:
+            return 0
+        # Keep the permissions and times of the file, not of the blob
+        shutil.copystat(filepath, temp)
+        os.replace(temp, filepath)
+        return size
+
+    def dedupe(self, dirpath, min_size=1, ignore=()):
+        """Add all regular files of at least ``min_size`` bytes in ``dirpath`` to the store.
+
+        Files and directories whose name is in ``ignore`` are skipped.
+
+        Returns the number of bytes saved."""
+        saved = 0
+        for root, dirs, files in os.walk(dirpath):
+            dirs[:] = [name for name in dirs if name not in ignore]
+            for name in files:
+                filepath = Path(root) / name
+                if name in ignore or filepath.is_symlink():
+                    continue
+                if filepath.stat().st_size >= min_size:
+                    saved += self.add(filepath)
+        return saved
+
+    def collect(self):
+        """Delete blobs which are no longer hard linked from any project.
+
+        Reflinked files don't need their blob, as they share its storage.
+
+        Returns the number of bytes freed."""
+        freed = 0
+        if not self.exists():
+            return freed
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(prefix.path):
+                stats = entry.stat(follow_symlinks=False)
+                if stats.st_nlink == 1:
+                    os.remove(entry.path)
+                    freed += stats.st_size
+        return freed
@@ -12,3 +12,28 @@ class DuplicateDtypeLabel(BrightwayError):
     """Dtype has conflicting labels"""
 
     pass
+
+
+class ActivationError(BrightwayError):
+    """One or more backends failed to activate or deactivate a project.
+
+    ``errors`` maps backend labels to their exceptions."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "Backend errors: "
+            + "; ".join("{}: {!r}".format(k, v) for k, v in errors.items())
+        )
+
+
+class ReadOnlyError(BrightwayError):
+    """Operation would modify a project catalog opened read-only"""
+
+    pass
+
+
+class LockTimeout(BrightwayError):
+    """A project lock couldn't be acquired in time"""
+
+    pass
@@ -1,12 +1,41 @@
 # -*- coding: utf-8 -*-
+from . import metrics
+from .errors import LockTimeout
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import errno
 import hashlib
+import json
+import mmap
 import os
 import re
+import shutil
+import stat
+import threading
+import time
 import unicodedata
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 re_slugify = re.compile(r"[^\w\s-]", re.UNICODE)
 
+# ``ioctl`` request number to clone a file (``FICLONE``) on Linux
+FICLONE = 0x40049409
+COPY_STRATEGIES = ("reflink", "hardlink", "copy")
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+HASH_ALGORITHMS = ("md5", "sha256", "blake2b")
+HASH_BLOCKSIZE = 1024 * 1024
+# Larger files are hashed through a memory map
+HASH_MMAP_THRESHOLD = 16 * 1024 * 1024
+WARM_MAX_BYTES = 256 * 1024 * 1024
+# Longest pause between attempts to acquire a ``FileLock`` with a timeout
+LOCK_POLL_INTERVAL = 0.05
+
 
 def safe_filename(string, add_hash=True):
     """Convert arbitrary strings to make them safe for filenames. Substitutes strange characters, and uses unicode normalization.
@@ -45,12 +74,506 @@ def get_dir_size(dirpath):
     )
 
 
-def md5(filepath, blocksize=65536):
-    """Generate MD5 hash for file at `filepath`"""
-    hasher = hashlib.md5()
-    fo = open(filepath, "rb")
-    buf = fo.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = fo.read(blocksize)
+def write_atomic(filepath, text):
+    """Write ``text`` to ``filepath`` through a temporary file, so that readers
+    never see a partially written file."""
+    filepath = Path(filepath)
+    temp = filepath.with_name("{}.{}.tmp".format(filepath.name, os.getpid()))
+    temp.write_text(text, encoding="utf-8")
+    os.replace(temp, filepath)
+
+
+class DirectorySizeIndex:
+    """Persistent, incrementally updated index of directory sizes.
+
+    For every directory we store its modification time, the size and
+    modification time of each file directly inside it, and the same
+    information for its subdirectories. A directory is only listed again (with
+    ``os.scandir``) when its modification time has changed, i.e. when entries
+    were added, removed, or renamed.
+
+    Files which change size in place don't change their directory's
+    modification time, so their new size is only seen with ``refresh="files"``,
+    which checks each recorded file with ``os.stat`` but lists only modified
+    directories, or ``refresh=True``, which rescans everything.
+
+    The index is stored as JSON at ``filepath``, if given. Symbolic links are not followed."""
+
+    def __init__(self, filepath=None):
+        self.filepath = Path(filepath) if filepath else None
+        self._lock = threading.Lock()
+        self._roots = {}
+        if self.filepath and self.filepath.is_file():
+            try:
+                with open(self.filepath, encoding="utf-8") as f:
+                    self._roots = json.load(f)
+            except ValueError:
+                # Corrupt index; it will be rebuilt
+                self._roots = {}
+
+    def size(self, dirpath, refresh=False):
+        """Total size of files in ``dirpath`` and its subdirectories, in bytes.
+
+        ``refresh`` is ``False``, ``"files"`` or ``True``; see above."""
+        if refresh not in (False, "files", True):
+            raise ValueError("Invalid refresh: {!r}".format(refresh))
+        key = os.path.abspath(dirpath)
+        with self._lock:
+            node = None if refresh is True else self._roots.get(key)
+        node = self._update(key, node, refresh)
+        with self._lock:
+            self._roots[key] = node
+        return self._total(node)
+
+    def retain(self, dirpaths):
+        """Drop cached directories other than ``dirpaths``."""
+        keys = {os.path.abspath(dirpath) for dirpath in dirpaths}
+        with self._lock:
+            self._roots = {k: v for k, v in self._roots.items() if k in keys}
+
+    def save(self):
+        if not self.filepath:
+            return
+        with self._lock:
+            data = json.dumps(self._roots)
+        write_atomic(self.filepath, data)
+
+    def _update(self, path, node, refresh):
+        """Return the up-to-date node ``[mtime_ns, {file name: [size, mtime_ns]},
+        {subdirectory name: node}]`` for ``path``."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return [None, {}, {}]
+        rescan = refresh is True or node is None or node[0] != mtime
+        # Indexes saved by earlier versions store the total size of the files
+        if rescan or type(node[1]) is not dict:
+            children = node[2] if node and refresh is not True else {}
+            files, subdirs = {}, {}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs[entry.name] = children.get(entry.name)
+                        else:
+                            stats = entry.stat()
+                            files[entry.name] = [stats.st_size, stats.st_mtime_ns]
+                    except OSError:
+                        # Vanished during the scan, or a broken link
+                        continue
+            node = [mtime, files, subdirs]
+            metrics.count("filesystem.directories_scanned")
+            metrics.count("filesystem.bytes_walked", self._files_size(node))
+        elif refresh == "files":
+            files = node[1]
+            for name in list(files):
+                try:
+                    stats = os.stat(os.path.join(path, name))
+                except OSError:
+                    # Vanished since the directory was checked
+                    del files[name]
+                    continue
+                files[name] = [stats.st_size, stats.st_mtime_ns]
+        for name, child in node[2].items():
+            node[2][name] = self._update(os.path.join(path, name), child, refresh)
+        return node
+
+    @staticmethod
+    def _files_size(node):
+        return sum(size for size, _ in node[1].values())
+
+    def _total(self, node):
+        return self._files_size(node) + sum(
+            self._total(child) for child in node[2].values()
+        )
+
+
+def warm_directory(dirpath, max_bytes=WARM_MAX_BYTES):
+    """Load the files in ``dirpath`` into the operating system page cache.
+
+    Where available, ``posix_fadvise`` asks the kernel to read files in the
+    background. Otherwise files are read and discarded, up to ``max_bytes``
+    in total.
+
+    Returns the number of bytes requested."""
+    requested = 0
+    for root, dirs, files in os.walk(dirpath):
+        for name in files:
+            if requested >= max_bytes:
+                return requested
+            try:
+                with open(os.path.join(root, name), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    else:
+                        remaining = max_bytes - requested
+                        while remaining > 0 and f.read(min(COPY_BUFSIZE, remaining)):
+                            remaining -= COPY_BUFSIZE
+            except OSError:
+                # Vanished, or not readable
+                continue
+            requested += size
+    return requested
+
+
+class FileLock:
+    """Advisory lock on ``filepath`` (created if needed), which can be held
+    by many readers (``shared``) or by a single writer.
+
+    Uses ``flock``, so locks belong to open files: two ``FileLock`` instances
+    exclude each other even within one process, and a lock is released when
+    its process exits. Without ``fcntl`` (Windows), locking does nothing.
+
+    ``timeout`` is the default number of seconds to wait in ``acquire``;
+    ``None`` waits indefinitely."""
+
+    def __init__(self, filepath, shared=False, timeout=None):
+        self.filepath = Path(filepath)
+        self.shared = shared
+        self.timeout = timeout
+        self.waited = 0.0
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, shared=None, timeout=False):
+        """Acquire the lock, or convert a held lock to ``shared`` or exclusive.
+
+        Waits up to ``timeout`` seconds (default ``self.timeout``), and raises
+        ``LockTimeout`` afterwards. If acquiring fails, the lock is released.
+
+        Returns the number of seconds waited, which is also stored in ``waited``."""
+        if shared is not None:
+            self.shared = shared
+        if timeout is False:
+            timeout = self.timeout
+        self.waited = 0.0
+        if fcntl is None:
+            return self.waited
+        start = time.perf_counter()
+        try:
+            if self._fd is None:
+                self._fd = self._open()
+            operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            if timeout is None:
+                fcntl.flock(self._fd, operation)
+            else:
+                delay = 0.001
+                while True:
+                    try:
+                        fcntl.flock(self._fd, operation | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        remaining = timeout - (time.perf_counter() - start)
+                        if remaining <= 0:
+                            raise LockTimeout(
+                                "Couldn't lock {} within {} seconds".format(
+                                    self.filepath, timeout
+                                )
+                            )
+                        time.sleep(min(delay, remaining))
+                        delay = min(delay * 2, LOCK_POLL_INTERVAL)
+        except BaseException:
+            self.release()
+            raise
+        self.waited = time.perf_counter() - start
+        return self.waited
+
+    def _open(self):
+        try:
+            return os.open(self.filepath, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        except OSError as error:
+            if not self.shared or error.errno not in (
+                errno.EACCES,
+                errno.EPERM,
+                errno.EROFS,
+            ):
+                raise
+            # Shared locks only need a readable file
+            return os.open(self.filepath, os.O_RDONLY | os.O_CLOEXEC)
+
+    def release(self):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def __enter__(self):
+        if not self.locked:
+            self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class NullLock:
+    """Stands in for a ``FileLock`` which can't be taken, e.g. because its
+    directory doesn't exist; acquiring and releasing do nothing."""
+
+    locked = False
+    waited = 0.0
+
+    def acquire(self, shared=None, timeout=False):
+        return self.waited
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def is_immutable(filepath):
+    """File has no write permission bits, so it is never modified in place."""
+    return not os.stat(filepath).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def reflink(src, dst):
+    """Create ``dst`` as a copy-on-write clone of ``src``.
+
+    Raises ``OSError`` if the platform or filesystem doesn't support reflinks."""
+    if fcntl is None or not hasattr(fcntl, "ioctl"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def _copy_range(src, dst, offset, length):
+    with open(src, "rb") as fsrc, open(dst, "r+b") as fdst:
+        if hasattr(os, "copy_file_range"):
+            # Copy inside the kernel, without passing the data through Python
+            try:
+                while length > 0:
+                    copied = os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), length, offset, offset
+                    )
+                    if not copied:
+                        return
+                    offset += copied
+                    length -= copied
+                return
+            except OSError:
+                pass
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        while length > 0:
+            buf = fsrc.read(min(COPY_BUFSIZE, length))
+            if not buf:
+                break
+            fdst.write(buf)
+            length -= len(buf)
+
+
+def copy_tree(
+    src,
+    dst,
+    ignore=(),
+    strategies=COPY_STRATEGIES,
+    workers=None,
+    chunk_size=COPY_CHUNK_SIZE,
+):
+    """Copy directory tree ``src`` to new directory ``dst``, as fast as possible.
+
+    Each file is copied with the first of ``strategies`` which works:
+
+    * ``reflink``: copy-on-write clone, on filesystems which support it
+    * ``hardlink``: hard link, only for immutable (read-only) files
+    * ``copy``: copy the data in chunks of ``chunk_size`` bytes, using a pool
+      of ``workers`` threads
+
+    Files and directories whose name is in ``ignore`` are skipped. Symbolic
+    links are copied as links.
+
+    Returns a dictionary with the number of files copied with each strategy."""
+    src, dst = Path(src), Path(dst)
+    counts = dict.fromkeys(strategies, 0)
+    use_reflink = "reflink" in strategies
+    copied = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for root, dirs, files in os.walk(src):
+            dirs[:] = [name for name in dirs if name not in ignore]
+            target = dst / Path(root).relative_to(src)
+            target.mkdir(parents=True, exist_ok=target != dst)
+            for name in files:
+                if name in ignore:
+                    continue
+                source, destination = Path(root) / name, target / name
+                if source.is_symlink():
+                    os.symlink(os.readlink(source), destination)
+                    continue
+                if use_reflink:
+                    try:
+                        reflink(source, destination)
+                        copied.append((source, destination))
+                        counts["reflink"] += 1
+                        continue
+                    except OSError:
+                        # Not supported by this filesystem; don't try again
+                        use_reflink = False
+                if "hardlink" in strategies and is_immutable(source):
+                    try:
+                        os.link(source, destination)
+                        counts["hardlink"] += 1
+                        continue
+                    except OSError:
+                        # E.g. different devices
+                        pass
+                if "copy" not in strategies:
+                    raise OSError("No copy strategy works for {}".format(source))
+                size = source.stat().st_size
+                with open(destination, "wb") as f:
+                    f.truncate(size)
+                for offset in range(0, size, chunk_size):
+                    futures.append(
+                        executor.submit(
+                            _copy_range, source, destination, offset, chunk_size
+                        )
+                    )
+                copied.append((source, destination))
+                counts["copy"] += 1
+        for future in futures:
+            future.result()
+
+    for source, destination in copied:
+        shutil.copystat(source, destination)
+    return counts
+
+
+def hash_file(filepath, algorithm="md5", blocksize=HASH_BLOCKSIZE):
+    """Generate hash of file at ``filepath`` with ``hashlib`` algorithm ``algorithm``.
+
+    Large files are hashed through a memory map, others are read in blocks of ``blocksize`` bytes."""
+    hasher = hashlib.new(algorithm)
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+        else:
+            for buf in iter(lambda: f.read(blocksize), b""):
+                hasher.update(buf)
     return hasher.hexdigest()
+
+
+def md5(filepath, blocksize=HASH_BLOCKSIZE):
+    """Generate MD5 hash for file at `filepath`"""
+    return hash_file(filepath, "md5", blocksize)
+
+
+class HashManifest:
+    """Persistent record of the hashes of all files in a directory tree.
+
+    Entries are keyed by path relative to the root directory, and store
+    ``(inode, size, mtime_ns, digest)``. A file is only hashed again when its
+    inode, size or modification time changed; hashing runs in a pool of
+    ``workers`` threads.
+
+    The manifest is stored as JSON at ``filepath``, if given."""
+
+    def __init__(self, filepath=None, algorithm="md5"):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(
+                "Hash algorithm must be one of {}".format(", ".join(HASH_ALGORITHMS))
+            )
+        self.filepath = Path(filepath) if filepath else None
+        self.algorithm = algorithm
+        self.entries = {}
+        if self.filepath and self.filepath.is_file():
+            data = json.loads(self.filepath.read_text(encoding="utf-8"))
+            if data.get("algorithm") == algorithm:
+                self.entries = data["files"]
+
+    @staticmethod
+    def scan(dirpath, ignore=(), symlinks=False):
+        """Return ``{relative path: (inode, size, mtime_ns)}`` for all regular files
+        in ``dirpath``, and for symbolic links (not followed) if ``symlinks``."""
+        result, stack = {}, [("", os.fspath(dirpath))]
+        while stack:
+            prefix, path = stack.pop()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name in ignore:
+                        continue
+                    relpath = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((relpath + "/", entry.path))
+                    elif entry.is_file(follow_symlinks=False) or (
+                        symlinks and entry.is_symlink()
+                    ):
+                        stats = entry.stat(follow_symlinks=False)
+                        result[relpath] = (
+                            stats.st_ino,
+                            stats.st_size,
+                            stats.st_mtime_ns,
+                        )
+        return result
+
+    def _hash(self, dirpath, relpaths, workers):
+        dirpath = Path(dirpath)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = executor.map(
+                lambda relpath: hash_file(dirpath / relpath, self.algorithm), relpaths
+            )
+            return dict(zip(relpaths, digests))
+
+    def _changed(self, current, full):
+        return [
+            relpath
+            for relpath, key in current.items()
+            if full
+            or relpath not in self.entries
+            or tuple(self.entries[relpath][:3]) != key
+        ]
+
+    def update(self, dirpath, ignore=(), workers=None):
+        """Hash new and changed files in ``dirpath``, and forget removed files.
+
+        Returns ``{relative path: digest}`` for all files."""
+        current = self.scan(dirpath, ignore)
+        digests = self._hash(dirpath, self._changed(current, False), workers)
+        self.entries = {
+            relpath: list(key) + [digests.get(relpath) or self.entries[relpath][3]]
+            for relpath, key in current.items()
+        }
+        return {relpath: entry[3] for relpath, entry in self.entries.items()}
+
+    def verify(self, dirpath, ignore=(), workers=None, full=False):
+        """Compare the files in ``dirpath`` with the recorded hashes, without updating them.
+
+        Only changed files are hashed, unless ``full``.
+
+        Returns a dictionary with lists of relative paths of ``modified``,
+        ``missing``, and ``added`` files."""
+        current = self.scan(dirpath, ignore)
+        changed = [x for x in self._changed(current, full) if x in self.entries]
+        digests = self._hash(dirpath, changed, workers)
+        return {
+            "modified": sorted(
+                relpath
+                for relpath, digest in digests.items()
+                if digest != self.entries[relpath][3]
+            ),
+            "missing": sorted(set(self.entries).difference(current)),
+            "added": sorted(set(current).difference(self.entries)),
+        }
+
+    def save(self):
+        if self.filepath:
+            write_atomic(
+                self.filepath,
+                json.dumps({"algorithm": self.algorithm, "files": self.entries}),
+            )
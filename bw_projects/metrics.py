@@ -0,0 +1,178 @@
+"""Timing spans and counters for project lifecycle operations.
+
+Instrumentation is off until a sink is enabled:
+
+.. code-block:: python
+
+    from bw_projects import metrics
+
+    store = metrics.enable()  # In-memory histograms
+    projects.select("foo")
+    store.summary()["projects.select"]
+
+Sinks implement ``record_span(name, seconds)`` and ``record_count(name, value)``;
+use ``CallbackSink`` to forward measurements to another metrics system. While no
+sink is enabled, spans and counters only check an empty tuple."""
+from bisect import bisect_left
+import functools
+import threading
+import time
+
+# Upper bounds of histogram buckets, in seconds; the last bucket is unbounded
+BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0, 100.0)
+
+_sinks = ()
+
+
+class Histogram:
+    """Count, total, extremes and bucketed distribution of durations."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class MemorySink:
+    """Keeps a ``Histogram`` per span name and a total per counter name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def record_span(self, name, seconds):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    def record_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Return ``{span name: histogram summary}``."""
+        with self._lock:
+            return {name: h.summary() for name, h in self.histograms.items()}
+
+    def clear(self):
+        with self._lock:
+            self.histograms, self.counters = {}, {}
+
+
+class CallbackSink:
+    """Calls ``callback(kind, name, value)`` for each measurement, where
+    ``kind`` is ``"span"`` (value in seconds) or ``"count"``."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record_span(self, name, seconds):
+        self.callback("span", name, seconds)
+
+    def record_count(self, name, value):
+        self.callback("count", name, value)
+
+
+def enable(*sinks):
+    """Start sending measurements to ``sinks``, in addition to sinks already enabled.
+
+    Without arguments, enables and returns a new ``MemorySink``."""
+    global _sinks
+    if not sinks:
+        sinks = (MemorySink(),)
+    _sinks = _sinks + tuple(sink for sink in sinks if sink not in _sinks)
+    return sinks[0]
+
+
+def disable(*sinks):
+    """Stop sending measurements to ``sinks``, or to all sinks if none are given."""
+    global _sinks
+    _sinks = tuple(sink for sink in _sinks if sinks and sink not in sinks)
+
+
+def enabled():
+    return bool(_sinks)
+
+
+class Span:
+    """Context manager which records the duration of its block as ``name``."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """Time a block: ``with metrics.span("name"): ...``"""
+    if not _sinks:
+        return _NULL_SPAN
+    return Span(name)
+
+
+def timed(name):
+    """Decorator which records each call of the decorated function as a span ``name``."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe(name, seconds):
+    """Record a duration measured elsewhere."""
+    for sink in _sinks:
+        sink.record_span(name, seconds)
+
+
+def count(name, value=1):
+    """Add ``value`` to the counter ``name``."""
+    for sink in _sinks:
+        sink.record_count(name, value)
@@ -1,18 +1,209 @@
 from collections.abc import Iterable
 from pathlib import Path
-from peewee import SqliteDatabase, TextField, BlobField
+from peewee import (
+    __exception_wrapper__,
+    BlobField,
+    FieldAccessor,
+    OperationalError,
+    SqliteDatabase,
+    TextField,
+)
+from . import metrics
 import json
+import os
+import random
+import struct
+import time
 
 
 abspath = lambda x: str(x.absolute()) if isinstance(x, Path) else x
 
 
-class JSONField(TextField):
+class JSONCodec:
+    """Encode values as JSON text."""
+
+    def __init__(self, ensure_ascii=True):
+        self.ensure_ascii = ensure_ascii
+
+    def encode(self, value):
+        return json.dumps(value, ensure_ascii=self.ensure_ascii)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_SHORT = struct.Struct("<B")
+_LONG = struct.Struct("<I")
+_CONSTANTS = {b"n": None, b"y": True, b"x": False}
+
+
+class PackedCodec:
+    """Encode values in a compact binary format, using ``struct``.
+
+    Supports ``None``, booleans, integers, floats, strings, bytes, and lists,
+    tuples and dictionaries of these; lists and tuples keep their type.
+
+    Each value is a one byte type tag followed by its data. Lengths below 256
+    take one byte (lowercase tags) instead of four (uppercase tags).
+
+    Encoded values start with a null byte, which JSON text never does, so
+    columns previously written as JSON can still be decoded.
+
+    Values are smaller than their JSON text, but decoding is done in Python
+    and is slower than ``json``; see ``benchmarks/fields.py``."""
+
+    MAGIC = b"\x00"
+
+    def encode(self, value):
+        parts = [self.MAGIC]
+        self._encode(value, parts.append)
+        return b"".join(parts)
+
+    @staticmethod
+    def _header(tag, length):
+        if length < 256:
+            return tag + _SHORT.pack(length)
+        return tag.upper() + _LONG.pack(length)
+
+    def _encode(self, value, write):
+        if value is None:
+            write(b"n")
+        elif value is True:
+            write(b"y")
+        elif value is False:
+            write(b"x")
+        elif isinstance(value, int):
+            if -(2 ** 63) <= value < 2 ** 63:
+                write(b"i" + _INT.pack(value))
+            else:
+                encoded = str(value).encode("ascii")
+                write(self._header(b"g", len(encoded)) + encoded)
+        elif isinstance(value, float):
+            write(b"f" + _FLOAT.pack(value))
+        elif isinstance(value, str):
+            encoded = value.encode("utf-8")
+            write(self._header(b"s", len(encoded)) + encoded)
+        elif isinstance(value, (bytes, bytearray)):
+            write(self._header(b"b", len(value)) + bytes(value))
+        elif isinstance(value, (tuple, list)):
+            tag = b"t" if isinstance(value, tuple) else b"l"
+            write(self._header(tag, len(value)))
+            for item in value:
+                self._encode(item, write)
+        elif isinstance(value, dict):
+            write(self._header(b"d", len(value)))
+            for key, item in value.items():
+                self._encode(key, write)
+                self._encode(item, write)
+        else:
+            raise ValueError("Can't encode {!r}".format(value))
+
+    def decode(self, raw):
+        raw = bytes(raw)
+        if raw[:1] != self.MAGIC:
+            return json.loads(raw)
+        value, _ = self._decode(raw, 1)
+        return value
+
+    def _decode(self, raw, offset):
+        tag, offset = raw[offset : offset + 1], offset + 1
+        if tag == b"i":
+            return _INT.unpack_from(raw, offset)[0], offset + 8
+        if tag == b"f":
+            return _FLOAT.unpack_from(raw, offset)[0], offset + 8
+        if tag in _CONSTANTS:
+            return _CONSTANTS[tag], offset
+        if tag.islower():
+            length, offset = raw[offset], offset + 1
+        else:
+            (length,), offset = _LONG.unpack_from(raw, offset), offset + 4
+            tag = tag.lower()
+        if tag == b"s" or tag == b"b" or tag == b"g":
+            chunk, offset = raw[offset : offset + length], offset + length
+            if tag == b"s":
+                return chunk.decode("utf-8"), offset
+            return (chunk if tag == b"b" else int(chunk)), offset
+        if tag == b"t" or tag == b"l" or tag == b"d":
+            items = []
+            for _ in range(length * 2 if tag == b"d" else length):
+                item, offset = self._decode(raw, offset)
+                items.append(item)
+            if tag == b"d":
+                return dict(zip(items[::2], items[1::2])), offset
+            return (tuple(items) if tag == b"t" else items), offset
+        raise ValueError("Invalid packed data")
+
+
+class LazyValue:
+    """Value read from the database which hasn't been decoded yet.
+
+    Lazy fields store these in model instances, and decode them on first
+    attribute access. Queries which return dictionaries or tuples instead of
+    model instances return them as is; use ``.value`` to decode."""
+
+    __slots__ = ("raw", "field")
+
+    def __init__(self, raw, field):
+        self.raw = raw
+        self.field = field
+
+    @property
+    def value(self):
+        return self.field.decode(self.raw)
+
+    def __repr__(self):
+        return "LazyValue({!r})".format(self.raw)
+
+
+class LazyFieldAccessor(FieldAccessor):
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        value = instance.__data__.get(self.name)
+        if type(value) is LazyValue:
+            value = instance.__data__[self.name] = value.value
+        return value
+
+
+class CodecFieldMixin:
+    """Field whose values are converted by ``codec``.
+
+    If ``lazy``, values read from the database are only decoded on first
+    attribute access, so reading rows is cheap when a field is never used.
+    Values are kept undecoded in ``__data__``, so code reading it directly
+    (e.g. ``playhouse.shortcuts.model_to_dict``) sees ``LazyValue`` objects."""
+
+    def __init__(self, *args, codec=None, lazy=False, **kwargs):
+        self.codec = codec or self.default_codec()
+        self.lazy = lazy
+        if lazy:
+            self.accessor_class = LazyFieldAccessor
+        super().__init__(*args, **kwargs)
+
+    def decode(self, raw):
+        return self.codec.decode(raw)
+
+    def decode_value(self, value):
+        return value if value is None else self.decode(value)
+
     def db_value(self, value):
-        return super().db_value(json.dumps(value))
+        if type(value) is LazyValue:
+            return super().db_value(value.raw)
+        return super().db_value(self.encode(value))
 
     def python_value(self, value):
-        return json.loads(value)
+        if value is not None and self.lazy:
+            return LazyValue(value, self)
+        return self.decode_value(value)
+
+
+class JSONField(CodecFieldMixin, TextField):
+    default_codec = JSONCodec
+
+    def encode(self, value):
+        return self.codec.encode(value)
 
 
 class PathField(TextField):
@@ -23,29 +214,209 @@ class PathField(TextField):
         return Path(value)
 
 
-class TupleField(BlobField):
-    def db_value(self, value):
+class TupleField(CodecFieldMixin, BlobField):
+    @staticmethod
+    def default_codec():
+        return JSONCodec(ensure_ascii=False)
+
+    def encode(self, value):
         if not isinstance(value, Iterable):
             raise ValueError("{} is not an iterable".format(value))
-        return super().db_value(json.dumps(tuple(value), ensure_ascii=False))
+        return self.codec.encode(tuple(value))
 
-    def python_value(self, value):
-        return tuple(json.loads(value))
+    def decode(self, raw):
+        return tuple(self.codec.decode(raw))
+
+
+def change_token(db):
+    """Return a token which changes whenever the database ``db`` is modified.
+
+    Combines SQLite's ``PRAGMA data_version``, which changes when *other*
+    connections commit, with the number of rows changed by our own connection.
+    Neither requires reading a table."""
+    connection = db.connection()
+    data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+    return (connection, data_version, connection.total_changes)
+
+
+PRAGMAS = {"foreign_keys": 1}
+
+# Tuned for many processes sharing one database file: with write-ahead logging
+# readers never block behind a writer, and ``synchronous=normal`` is safe in WAL mode.
+CONCURRENT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "foreign_keys": 1,
+    "temp_store": "memory",
+    "cache_size": -16000,
+    "mmap_size": 2 ** 28,
+}
+
+# Read-only connections can't change the journal mode
+READONLY_PRAGMAS = {
+    "foreign_keys": 1,
+    "temp_store": "memory",
+    "cache_size": -16000,
+    "mmap_size": 2 ** 28,
+}
+
+
+def readonly_uri(filepath, immutable=False):
+    """SQLite URI to open ``filepath`` read-only.
+
+    If ``immutable``, SQLite assumes that nobody changes the file while it is
+    open, and skips all locking and change detection."""
+    uri = "{}?mode=ro".format(Path(filepath).absolute().as_uri())
+    return uri + "&immutable=1" if immutable else uri
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return "database is locked" in message or "database is busy" in message
+
+
+class MeteredSqliteDatabase(SqliteDatabase):
+    """``SqliteDatabase`` which counts the statements it executes as the
+    ``metrics`` counter ``query_metric``, if given."""
+
+    def __init__(self, database, query_metric=None, **kwargs):
+        self.query_metric = query_metric
+        super().__init__(database, **kwargs)
+
+    def execute_sql(self, *args, **kwargs):
+        if self.query_metric is not None:
+            metrics.count(self.query_metric)
+        return super().execute_sql(*args, **kwargs)
+
+
+class ConcurrentSqliteDatabase(MeteredSqliteDatabase):
+    """``SqliteDatabase`` for concurrent access by many threads and processes.
+
+    * Write transactions start with ``BEGIN IMMEDIATE``, so they wait for the
+      write lock up front instead of failing when upgrading a read lock.
+    * Statements outside a transaction, and transaction starts, are retried
+      with exponential backoff if SQLite is still busy after ``timeout``.
+    * Each thread gets its own connection (peewee's default), and connections
+      inherited from a parent process are never reused after ``fork``."""
+
+    def __init__(
+        self, database, retries=5, backoff=0.05, lock_type="IMMEDIATE", **kwargs
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        # Not passed on: only peewee 4 knows ``lock_type``
+        self.begin_lock_type = lock_type
+        self._pid = os.getpid()
+        super().__init__(database, **kwargs)
+
+    def _retry(self, func, *args, **kwargs):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                if attempt == self.retries or not is_busy_error(error):
+                    raise
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Forked; the inherited connection belongs to the parent
+            self._pid = os.getpid()
+            self._state.reset()
+
+    def connection(self):
+        self._check_pid()
+        return super().connection()
+
+    def cursor(self, *args, **kwargs):
+        self._check_pid()
+        return super().cursor(*args, **kwargs)
+
+    def begin(self, lock_type=None):
+        statement = "BEGIN {}".format(lock_type or self.begin_lock_type)
+        # Not ``super().begin``, whose behaviour differs between peewee versions,
+        # nor ``execute_sql``, which commits at once on peewee < 3.17
+        return self._retry(self._execute_begin, statement)
+
+    def _execute_begin(self, statement):
+        with __exception_wrapper__:
+            self.cursor().execute(statement)
+
+    def execute_sql(self, *args, **kwargs):
+        if self.in_transaction():
+            # Retrying a single statement can't repair a failed transaction
+            return super().execute_sql(*args, **kwargs)
+        return self._retry(super().execute_sql, *args, **kwargs)
 
 
 class SubstitutableDatabase(object):
-    def __init__(self, filepath=":memory:", tables=[]):
+    """Database whose file can be changed at runtime, and which is shared by ``tables``.
+
+    If ``concurrent``, the database is tuned for simultaneous use by several
+    threads and processes (see ``ConcurrentSqliteDatabase``), and waits up to
+    ``busy_timeout`` seconds for locks held by other connections.
+
+    If ``readonly``, the existing database file is opened with SQLite's
+    ``mode=ro`` (and ``immutable=1`` if ``immutable``), lazily, and tables are
+    not created. Writes raise ``OperationalError``.
+
+    If ``query_metric`` is given, every statement is counted under this name
+    in ``metrics``."""
+
+    def __init__(
+        self,
+        filepath=":memory:",
+        tables=[],
+        concurrent=False,
+        busy_timeout=5.0,
+        readonly=False,
+        immutable=False,
+        query_metric=None,
+    ):
         self._tables = tables
+        self.query_metric = query_metric
+        self.concurrent = concurrent
+        self.busy_timeout = busy_timeout
+        self.readonly = readonly or immutable
+        self.immutable = immutable
         self._create_database(filepath)
 
     def _create_database(self, filepath):
-        self._db = SqliteDatabase(
-            abspath(filepath) if filepath != ":memory:" else filepath,
-            pragmas={"foreign_keys": 1},
-        )
+        filepath = abspath(filepath) if filepath != ":memory:" else filepath
+        if self.readonly:
+            if filepath == ":memory:":
+                raise ValueError("In-memory databases can't be read-only")
+            self._db = MeteredSqliteDatabase(
+                readonly_uri(filepath, self.immutable),
+                query_metric=self.query_metric,
+                pragmas=READONLY_PRAGMAS,
+                timeout=self.busy_timeout,
+                uri=True,
+            )
+            for model in self._tables:
+                model.bind(self._db, bind_refs=False, bind_backrefs=False)
+            return
+        if self.concurrent:
+            self._db = ConcurrentSqliteDatabase(
+                filepath,
+                query_metric=self.query_metric,
+                pragmas=CONCURRENT_PRAGMAS,
+                timeout=self.busy_timeout,
+            )
+        else:
+            self._db = MeteredSqliteDatabase(
+                filepath,
+                query_metric=self.query_metric,
+                pragmas=PRAGMAS,
+                timeout=self.busy_timeout,
+            )
         for model in self._tables:
             model.bind(self._db, bind_refs=False, bind_backrefs=False)
-        self._db.connect()
+        if not self.concurrent:
+            # Concurrent databases connect lazily, once per thread
+            self._db.connect()
         self._db.create_tables(self._tables, safe=True)
 
     def _change_path(self, filepath):
@@ -1,14 +1,81 @@
 # -*- coding: utf-8 -*-
-from . import backend_mapping
-from .errors import MissingBackend
-from .filesystem import safe_filename, get_dir_size, create_dir
-from .peewee import JSONField, PathField
-from peewee import Model, TextField, BooleanField, DoesNotExist
+from . import backend_mapping, metrics
+from .blobs import BlobStore
+from .errors import ActivationError, LockTimeout, MissingBackend, ReadOnlyError
+from .filesystem import (
+    copy_tree,
+    create_dir,
+    DirectorySizeIndex,
+    FileLock,
+    HashManifest,
+    NullLock,
+    safe_filename,
+    warm_directory,
+    write_atomic,
+)
+from .peewee import JSONField, PathField, SubstitutableDatabase, change_token
+from peewee import (
+    BooleanField,
+    Case,
+    chunked,
+    DoesNotExist,
+    fn,
+    Model,
+    SQL,
+    TextField,
+)
+from concurrent.futures import (
+    as_completed,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError,
+)
 import collections
+import functools
+import glob
 import os
+import re
 import shutil
+import sys
+import threading
+import time
+import uuid
 import warnings
 
+# Per-project lock file, see ``ProjectManager.lock``
+LOCK_FILE = "write-lock"
+# Seconds to wait for a project lock held by another process
+LOCK_TIMEOUT = 10.0
+# Never copied between projects
+IGNORED_FILES = {LOCK_FILE}
+# Rows per statement in bulk catalog operations
+BATCH_SIZE = 500
+# Directories of deleted projects wait here to be purged
+TRASH_DIR = ".trash"
+TRASH_LABEL = "<pending deletion>"
+# Project directories are either all in the base directory ("flat"), or nested
+# in two levels of subdirectories named after their hash ("sharded")
+LAYOUTS = ("flat", "sharded")
+LAYOUT_FILE = ".layout"
+
+
+def mutating(method):
+    """Raise ``ReadOnlyError`` instead of calling ``method`` in read-only mode."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.readonly:
+            raise ReadOnlyError(
+                "Can't call {} on a read-only ProjectManager".format(method.__name__)
+            )
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+re_metadata_key = re.compile(r"^\w+$")
+re_shard = re.compile(r"^[0-9a-f]{2}$")
+
 
 class Project(Model):
     data = JSONField(default={})
@@ -18,6 +85,14 @@ class Project(Model):
     default = BooleanField(default=False)
     enabled = BooleanField(default=True)
 
+    class Meta:
+        indexes = (
+            SQL(
+                "CREATE INDEX IF NOT EXISTS project_name_nocase "
+                "ON project (name COLLATE NOCASE)"
+            ),
+        )
+
     def __str__(self):
         return "Project: {}".format(self.name)
 
@@ -31,15 +106,62 @@ class Project(Model):
             return self.name.lower() < other.name.lower()
 
     def backends_resolved(self):
+        """Yield the backends of this project, importing them if needed"""
         for label in self.backends or []:
-            yield backend_mapping[label]
+            try:
+                yield backend_mapping[label]
+            except KeyError:
+                raise MissingBackend(f"Backend {label} missing")
+
+    def backends_items(self):
+        """Yield ``(label, backend)`` pairs"""
+        return zip(self.backends or [], self.backends_resolved())
 
 
 class ProjectManager(collections.abc.Iterable):
-    def __init__(self, base_dir, base_log_dir):
+    """Manages the projects in ``base_dir``.
+
+    If ``readonly``, no directories are created, and methods which would
+    modify projects or the catalog raise ``ReadOnlyError``; selecting,
+    listing, exporting and reporting still work. Use this with a read-only
+    ``SubstitutableDatabase``."""
+
+    def __init__(
+        self,
+        base_dir,
+        base_log_dir,
+        backend_timeout=None,
+        lock_timeout=LOCK_TIMEOUT,
+        readonly=False,
+    ):
         self.base_dir = base_dir
+        self.readonly = readonly
         self.base_log_dir = base_log_dir
-        self.create_base_dirs()
+        self.backend_timeout = backend_timeout
+        self.backend_timings = {}
+        self.lock_timeout = lock_timeout
+        self.lock_timings = {}
+        self._held_lock = None
+        self._prefetched = {}
+        self._schedule = collections.deque()
+        self._prefetcher = None
+        self._reaper = None
+        self._reaping = False
+        self._trash_dirty = False
+        self._reaper_lock = threading.Lock()
+        self._purge_lock = threading.Lock()
+        self._cache = None
+        self._size_index = None
+        self._layout = None
+        if not readonly:
+            self.create_base_dirs()
+        if (
+            not readonly
+            and self.trash_dir.is_dir()
+            and any(os.scandir(self.trash_dir))
+        ):
+            # Resume purging after an interruption
+            self.start_reaper()
         try:
             self.current = Project.get(Project.default == True)
         except DoesNotExist:
@@ -60,60 +182,538 @@ class ProjectManager(collections.abc.Iterable):
             )
             warnings.warn(WARNING)
 
+    @property
+    def layout(self):
+        """Layout of new project directories; one of ``LAYOUTS``.
+
+        Stored in the ``.layout`` file of the base directory, and changed
+        with ``migrate_layout``."""
+        if self._layout is None or self._layout[0] != self.base_dir:
+            try:
+                layout = (self.base_dir / LAYOUT_FILE).read_text().strip()
+            except FileNotFoundError:
+                layout = "flat"
+            self._layout = (self.base_dir, layout)
+        return self._layout[1]
+
+    def project_directory(self, name, layout=None):
+        """Return the directory path for a new project ``name``.
+
+        With the ``sharded`` layout, directories are nested by the first two
+        pairs of characters of the hash in their ``safe_filename``, e.g.
+        ``base_dir/ab/cd/name.abcd...``, to keep directory listings short."""
+        layout = layout or self.layout
+        dirname = safe_filename(name)
+        if layout == "flat":
+            return self.base_dir / dirname
+        elif layout == "sharded":
+            digest = dirname.rsplit(".", 1)[-1]
+            return self.base_dir / digest[:2] / digest[2:4] / dirname
+        raise ValueError("Layout must be one of {}".format(", ".join(LAYOUTS)))
+
+    @mutating
+    def migrate_layout(self, layout):
+        """Move the directories of all projects to ``layout`` (one of ``LAYOUTS``).
+
+        Directories are renamed in place, and ``Project.directory`` is updated
+        in batches of ``BATCH_SIZE`` rows. Projects whose directory is outside
+        the base directory are left alone. New projects use ``layout`` as
+        soon as this starts; if interrupted, run it again to finish.
+
+        Returns the number of directories moved."""
+        if layout not in LAYOUTS:
+            raise ValueError("Layout must be one of {}".format(", ".join(LAYOUTS)))
+        write_atomic(self.base_dir / LAYOUT_FILE, layout)
+        self._layout = None
+
+        moved = 0
+        base_dir = self.base_dir.absolute()
+        query = Project.select(Project.id, Project.name, Project.directory)
+        for batch in chunked(list(query), BATCH_SIZE):
+            targets = {}
+            for obj in batch:
+                target = self.project_directory(obj.name, layout).absolute()
+                if obj.directory == target or base_dir not in obj.directory.parents:
+                    continue
+                if obj.directory.exists() and not target.exists():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.rename(obj.directory, target)
+                    moved += 1
+                targets[obj.id] = str(target)
+            if targets:
+                with Project._meta.database.atomic():
+                    Project.update(
+                        directory=Case(Project.id, list(targets.items()))
+                    ).where(Project.id.in_(list(targets))).execute()
+
+        if layout == "flat":
+            self._remove_empty_shards()
+        if self.current is not None:
+            self.current = Project.get(Project.id == self.current.id)
+        return moved
+
+    def _remove_empty_shards(self):
+        for entry in os.scandir(self.base_dir):
+            if not (entry.is_dir(follow_symlinks=False) and re_shard.match(entry.name)):
+                continue
+            for child in os.scandir(entry.path):
+                if child.is_dir(follow_symlinks=False) and re_shard.match(child.name):
+                    try:
+                        os.rmdir(child.path)
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(entry.path)
+            except OSError:
+                pass
+
+    def _catalog(self):
+        """Return all projects, including disabled ones, as a dictionary keyed by name.
+
+        The catalog is cached in memory, and only read again when the project
+        database has changed, either through this connection or through
+        another process."""
+        db = Project._meta.database
+        token = change_token(db)
+        if self._cache is not None and self._cache[0] == token:
+            return self._cache[1]
+        catalog = {obj.name: obj for obj in Project.select()}
+        # Uncommitted changes could still be rolled back without changing the token
+        if not db.in_transaction():
+            self._cache = (token, catalog)
+        return catalog
+
     def __iter__(self):
-        for project_ds in Project.select().where(Project.enabled == True):
-            yield project_ds
+        for project_ds in list(self._catalog().values()):
+            if project_ds.enabled:
+                yield project_ds
+
+    @staticmethod
+    def _metadata_key(key):
+        """Return JSON path and generated column name for metadata ``key``.
+
+        Dots in ``key`` separate the keys of nested objects."""
+        parts = key.split(".")
+        if not all(re_metadata_key.match(part) for part in parts):
+            raise ValueError("Invalid metadata key: {}".format(key))
+        path = "$." + ".".join('"{}"'.format(part) for part in parts)
+        return path, "meta__" + "__".join(parts)
+
+    def _promoted_columns(self):
+        db = Project._meta.database
+        # Generated columns are only listed by ``table_xinfo``
+        return {
+            row[1]
+            for row in db.execute_sql("PRAGMA table_xinfo(project)").fetchall()
+            if row[1].startswith("meta__")
+        }
+
+    @mutating
+    def promote_key(self, key):
+        """Add an indexed generated column for metadata ``key``, so that
+        ``filter`` queries on it don't need to scan and parse every project.
+
+        Requires SQLite 3.31 or later."""
+        path, column = self._metadata_key(key)
+        if column in self._promoted_columns():
+            return
+        db = Project._meta.database
+        with db.atomic():
+            db.execute_sql(
+                'ALTER TABLE project ADD COLUMN "{}" GENERATED ALWAYS AS '
+                "(json_extract(data, '{}')) VIRTUAL".format(column, path)
+            )
+            db.execute_sql(
+                'CREATE INDEX IF NOT EXISTS "project_{0}" ON project ("{0}")'.format(
+                    column
+                )
+            )
+
+    def filter(self, page_size=1000, **criteria):
+        """Yield enabled projects whose metadata matches all ``criteria``.
+
+        Each criterion compares the metadata value stored under its key (given
+        as keyword arguments to ``create_project``) with a number, string,
+        boolean or ``None``. Use ``**{"a.b": value}`` for nested keys.
+
+        Comparisons run inside SQLite with ``json_extract``, or on an indexed
+        column for keys added with ``promote_key``. Projects are read
+        ``page_size`` at a time."""
+        promoted = self._promoted_columns()
+        query = Project.select().where(Project.enabled == True)
+        for key, value in criteria.items():
+            if isinstance(value, (dict, list, tuple)):
+                raise ValueError("Can only filter on scalar values")
+            path, column = self._metadata_key(key)
+            if column in promoted:
+                expression = SQL('"{}"'.format(column))
+            else:
+                expression = fn.json_extract(Project.data, path)
+            if value is None:
+                query = query.where(expression.is_null())
+            else:
+                query = query.where(expression == value)
+
+        last_id = 0
+        while True:
+            page = list(
+                query.where(Project.id > last_id).order_by(Project.id).limit(page_size)
+            )
+            yield from page
+            if len(page) < page_size:
+                return
+            last_id = page[-1].id
 
     def __contains__(self, name):
-        return Project.select().where(Project.name == name).count() > 0
+        return name in self._catalog()
 
     def __len__(self):
-        return Project.select().where(Project.enabled == True).count()
+        return sum(1 for obj in self._catalog().values() if obj.enabled)
 
     def __repr__(self):
-        if len(self) > 20:
+        # Doesn't load the catalog, which ``len(self)`` would do
+        count = (
+            Project.select(fn.COUNT(SQL("*")))
+            .where(Project.enabled == True)
+            .scalar()
+        )
+        if count > 20:
             return (
                 "Brightway projects manager with {} objects, including:"
                 "{}\nUse `sorted(projects)` to get full list, "
                 "`projects.report()` to get\n\ta report on all projects."
             ).format(
-                len(self),
-                "".join(
-                    ["\n\t{}".format(x) for x in sorted([x.name for x in self])[:10]]
-                ),
+                count, "".join(["\n\t{}".format(x) for x in self.names(limit=10)]),
             )
         else:
             return (
                 "Brightway projects manager with {} objects:{}"
                 "\nUse `projects.report()` to get a report on all projects."
             ).format(
-                len(self),
-                "".join(["\n\t{}".format(x) for x in sorted([x.name for x in self])]),
+                count, "".join(["\n\t{}".format(x) for x in self.names()]),
             )
 
+    def names(self, prefix=None, limit=None, offset=0, order="name"):
+        """Return the names of enabled projects, without loading the projects themselves.
+
+        ``prefix`` selects names starting with this string, ignoring ASCII case.
+        ``order`` is ``"name"`` (case-insensitive), ``"created"``, or ``None``
+        for no particular order. ``limit`` and ``offset`` allow paging.
+
+        Runs one query, which uses a ``COLLATE NOCASE`` index on names."""
+        if order not in ("name", "created", None):
+            raise ValueError("Invalid order: {}".format(order))
+        name = Project.name.collate("NOCASE")
+        query = Project.select(Project.name).where(Project.enabled == True)
+        if prefix:
+            # NOCASE folds ASCII letters to lowercase
+            lower = "".join(c.lower() if "A" <= c <= "Z" else c for c in prefix)
+            query = query.where(name >= lower)
+            if ord(lower[-1]) < sys.maxunicode:
+                query = query.where(name < lower[:-1] + chr(ord(lower[-1]) + 1))
+            else:
+                query = query.where(Project.name.startswith(prefix))
+        if order == "name":
+            query = query.order_by(name)
+        elif order == "created":
+            query = query.order_by(Project.id)
+        if limit is not None or offset:
+            query = query.limit(limit).offset(offset)
+        return [row[0] for row in query.tuples()]
+
     @property
     def dir(self):
         return self.current.directory if self.current else None
 
+    def _resolve(self, project=None):
+        """Return the ``Project`` for ``project``, which can be a name, a
+        ``Project``, or ``None`` for the current project."""
+        if project is None:
+            if self.current is None:
+                raise ValueError("No project selected")
+            return self.current
+        if isinstance(project, Project):
+            return project
+        try:
+            return self._catalog()[project]
+        except KeyError:
+            raise ValueError("{} is not a project".format(project))
+
+    @metrics.timed("projects.select")
     def select(self, name):
-        if name not in self:
-            raise ValueError("Project f{name} doesn't exist")
-        if self.current:
-            self.deactivate()
-        self.current = Project.get(name=name)
-        self.activate()
-
-    def activate(self):
-        """Activate the current project with its backends"""
-        for backend in self.current.backends_resolved():
-            backend.activate_project(self.current)
-
-    def deactivate(self):
-        """Deactivate the current project with its backends"""
-        for backend in self.current.backends_resolved():
-            backend.deactivate_project()
+        """Switch to project ``name``.
+
+        Backends used by both the current and the new project, and which
+        define ``switch_project(old, new)``, are switched directly instead of
+        being deactivated and activated again. Only the other backends of the
+        current project are deactivated, and only the other backends of the
+        new project are activated.
+
+        The selected project is held with a shared lock (see ``lock``) until
+        another project is selected or it is deactivated."""
+        try:
+            obj = self._catalog()[name]
+        except KeyError:
+            raise ValueError(f"Project {name} doesn't exist")
+        self._wait_for_prefetch(name)
+        if self._schedule and self._schedule[0] == name:
+            self._schedule.popleft()
+            if self._schedule:
+                self.prefetch(self._schedule[0])
+
+        lock = self._acquire(self.lock(obj), "select")
+        if name not in self._catalog():
+            # Deleted while we were waiting
+            lock.release()
+            raise ValueError(f"Project {name} doesn't exist")
+        previous, self._held_lock = self._held_lock, lock
+        try:
+            self._switch(obj)
+        finally:
+            if previous is not None:
+                previous.release()
+
+    def _switch(self, obj):
+        if not self.current:
+            self.current = obj
+            self.activate()
+            return
+
+        old, new_items = self.current, list(obj.backends_items())
+        shared = {
+            label
+            for label, backend in new_items
+            if label in (old.backends or []) and hasattr(backend, "switch_project")
+        }
+        self.current = None
+        self._run_hooks(
+            "deactivate_project",
+            [(label, b) for label, b in old.backends_items() if label not in shared],
+        )
+        self.current = obj
+        self._run_hooks(
+            "switch_project",
+            [(label, b) for label, b in new_items if label in shared],
+            (old, obj),
+        )
+        self._run_hooks(
+            "activate_project",
+            [(label, b) for label, b in new_items if label not in shared],
+            (obj,),
+        )
+
+    def _prepare(self, obj):
+        for label, backend in obj.backends_items():
+            if hasattr(backend, "prepare_project"):
+                _call_hook("prepare_project", label, backend, obj)
+        warm_directory(obj.directory)
+        return obj
+
+    def prefetch(self, name):
+        """Prepare project ``name`` in a background thread, so that a later
+        ``select(name)`` is fast.
+
+        Preparation imports the project's backends, calls their optional
+        ``prepare_project(project)`` hook, and loads the project directory
+        into the page cache.
+
+        Returns a ``concurrent.futures.Future``."""
+        obj = self._resolve(name)
+        if name not in self._prefetched:
+            if self._prefetcher is None:
+                self._prefetcher = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="bw_projects-prefetch"
+                )
+            self._prefetched[name] = self._prefetcher.submit(self._prepare, obj)
+        return self._prefetched[name]
+
+    def schedule(self, names):
+        """Declare the projects which will be selected next, in order.
+
+        The first project is prefetched immediately; each time the next
+        scheduled project is selected, the one after it is prefetched."""
+        self._schedule = collections.deque(names)
+        if self._schedule:
+            self.prefetch(self._schedule[0])
+
+    def map(self, func, names=None, workers=None):
+        """Call ``func(project)`` for each of the projects ``names`` (default
+        is all enabled projects) in a pool of ``workers`` processes.
+
+        Each worker opens the catalog read-only (see ``readonly``), and
+        selects and activates the project before calling ``func``, which must
+        be picklable, e.g. a module-level function. Within a worker,
+        ``bw_projects.projects`` is the worker's own ``ProjectManager``.
+        Workers keep their backends imported and their project selected
+        between calls, so consecutive calls are cheap. Backends added to
+        ``backend_mapping`` at runtime, instead of through entry points, are
+        only available if worker processes are forked.
+
+        Yields ``(name, result, exception)`` in completion order; ``result``
+        is ``None`` if ``func`` raised ``exception``, and ``exception`` is
+        ``None`` otherwise."""
+        database = Project._meta.database.database
+        if database == ":memory:":
+            raise ValueError("Can't share an in-memory catalog with worker processes")
+        names = self.names() if names is None else list(names)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_map_worker,
+            initargs=(database, self.base_dir, self.base_log_dir, self.lock_timeout),
+        ) as executor:
+            futures = {executor.submit(_map_call, func, name): name for name in names}
+            for future in as_completed(futures):
+                error = future.exception()
+                result = None if error is not None else future.result()
+                yield futures[future], result, error
+
+    def _wait_for_prefetch(self, name):
+        future = self._prefetched.pop(name, None)
+        if future is None:
+            return
+        try:
+            future.result()
+        except Exception as error:
+            # Preparation is only an optimization; activation will try again
+            warnings.warn("Prefetching project {} failed: {!r}".format(name, error))
+
+    def _run_hooks(self, hook, items, args=(), timeout=None):
+        """Call ``hook(*args)`` on each backend of ``items``, a list of ``(label, backend)``.
+
+        Backends which set ``__brightway_concurrent_activation__`` are called in
+        parallel in a thread pool, and are given ``timeout`` seconds (default
+        ``self.backend_timeout``) to finish. All other backends are called in
+        order in the calling thread. The time taken by each backend is stored
+        in ``self.backend_timings[hook]``.
+
+        Raises ``ActivationError`` with all errors once every backend has finished."""
+        if timeout is None:
+            timeout = self.backend_timeout
+        timings, errors = {}, {}
+        self.backend_timings[hook] = timings
+
+        def call(label, backend):
+            start = time.perf_counter()
+            try:
+                getattr(backend, hook)(*args)
+            finally:
+                timings[label] = time.perf_counter() - start
+                metrics.observe("backend.{}.{}".format(hook, label), timings[label])
+
+        concurrent = [
+            (label, backend)
+            for label, backend in items
+            if getattr(backend, "__brightway_concurrent_activation__", False)
+        ]
+        executor = None
+        if concurrent:
+            executor = ThreadPoolExecutor(max_workers=len(concurrent))
+        try:
+            futures = [
+                (label, executor.submit(call, label, backend))
+                for label, backend in concurrent
+            ]
+            start = time.perf_counter()
+            for label, backend in items:
+                if (label, backend) in concurrent:
+                    continue
+                try:
+                    call(label, backend)
+                except Exception as error:
+                    errors[label] = error
+            for label, future in futures:
+                remaining = None
+                if timeout is not None:
+                    remaining = max(0, timeout - (time.perf_counter() - start))
+                try:
+                    future.result(timeout=remaining)
+                except TimeoutError:
+                    errors[label] = TimeoutError(
+                        "{} timed out after {} seconds".format(hook, timeout)
+                    )
+                except Exception as error:
+                    errors[label] = error
+        finally:
+            if executor is not None:
+                # Don't wait for backends which timed out
+                executor.shutdown(wait=False)
+        if errors:
+            raise ActivationError(errors)
+
+    @metrics.timed("projects.activate")
+    def activate(self, timeout=None):
+        """Activate the current project with its backends.
+
+        See ``_run_hooks`` for concurrent activation and ``timeout``."""
+        self._run_hooks(
+            "activate_project",
+            list(self.current.backends_items()),
+            (self.current,),
+            timeout,
+        )
+
+    @metrics.timed("projects.deactivate")
+    def deactivate(self, timeout=None):
+        """Deactivate the current project with its backends.
+
+        See ``_run_hooks`` for concurrent deactivation and ``timeout``."""
+        items = list(self.current.backends_items())
         self.current = None
+        try:
+            self._run_hooks("deactivate_project", items, timeout=timeout)
+        finally:
+            if self._held_lock is not None:
+                self._held_lock.release()
+                self._held_lock = None
+
+    def lock(self, project=None, shared=True, timeout=None):
+        """Return a ``filesystem.FileLock`` on ``project`` (default is the
+        current project); use it as a context manager.
 
+        Project locks are advisory, and work across processes. ``select``,
+        ``copy_project`` and ``export_project`` hold shared locks, so many
+        processes can use the same project, while ``delete_project`` needs an
+        exclusive lock. ``timeout`` defaults to ``self.lock_timeout`` seconds.
+
+        The time spent waiting for locks by each operation is stored in
+        ``self.lock_timings``."""
+        project = self._resolve(project)
+        if timeout is None:
+            timeout = self.lock_timeout
+        return FileLock(project.directory / LOCK_FILE, shared, timeout)
+
+    def _acquire(self, lock, operation, **kwargs):
+        try:
+            waited = lock.acquire(**kwargs)
+        except OSError as error:
+            # No project directory, so nothing to protect, or a read-only
+            # directory without a lock file
+            if isinstance(error, FileNotFoundError) or self.readonly:
+                return NullLock()
+            raise
+        self.lock_timings[operation] = waited
+        metrics.observe("lock_wait.{}".format(operation), waited)
+        return lock
+
+    def _exclusive_lock(self, project, operation, timeout=False):
+        """Acquire an exclusive lock on ``project``, converting our own
+        shared lock if ``project`` is selected."""
+        if timeout is False:
+            timeout = self.lock_timeout
+        if project == self.current and self._held_lock is not None:
+            lock, self._held_lock = self._held_lock, None
+            try:
+                return self._acquire(lock, operation, shared=False, timeout=timeout)
+            except LockTimeout:
+                # Converting released the lock; take it back
+                self._held_lock = self._acquire(lock, "select", shared=True)
+                raise
+        return self._acquire(
+            self.lock(project, shared=False), operation, timeout=timeout
+        )
+
+    @mutating
+    @metrics.timed("projects.create_project")
     def create_project(
         self, name, backends=("default",), switch=True, default=False, **kwargs
     ):
@@ -132,8 +732,8 @@ class ProjectManager(collections.abc.Iterable):
             if backend not in backend_mapping:
                 raise MissingBackend(f"Backend {backend} missing")
 
-        dirpath = self.base_dir / safe_filename(name)
-        dirpath.mkdir()
+        dirpath = self.project_directory(name)
+        dirpath.mkdir(parents=True)
         if default:
             # Set all other projects to non-default
             Project.update(default=False).execute()
@@ -145,54 +745,568 @@ class ProjectManager(collections.abc.Iterable):
             default=default,
         )
 
-        for backend in obj.backends_resolved():
+        for label, backend in obj.backends_items():
             if getattr(backend, "__brightway_common_api__", None):
-                backend.create_project(obj, **kwargs)
+                _call_hook("create_project", label, backend, obj, **kwargs)
+
+        if switch:
+            self.select(name)
+
+    @mutating
+    @metrics.timed("projects.create_projects")
+    def create_projects(self, specs, workers=None):
+        """Create many projects at once.
+
+        Each item of ``specs`` is a project name, or a dictionary with the
+        keyword arguments of ``create_project``, except ``switch`` and ``default``.
+
+        Project directories are created in a pool of ``workers`` threads, and
+        all catalog entries are inserted in one transaction. Backends which
+        define ``create_projects(projects)`` are called once with all their new
+        projects; otherwise ``create_project(project, **metadata)`` is called
+        for each project. Projects for which a backend is missing or fails are
+        removed again.
+
+        Returns a dictionary of ``{name: exception}`` for projects which
+        couldn't be created."""
+        failures, rows = {}, {}
+        for spec in specs:
+            spec = {"name": spec} if isinstance(spec, str) else dict(spec)
+            name = spec.pop("name")
+            backends = tuple(spec.pop("backends", ("default",)))
+            if name in self or name in rows:
+                failures[name] = ValueError("Project {} already exists".format(name))
+                continue
+            missing = [label for label in backends if label not in backend_mapping]
+            if missing:
+                failures[name] = MissingBackend(
+                    "Backend {} missing".format(", ".join(missing))
+                )
+                continue
+            rows[name] = {
+                "name": name,
+                "directory": self.project_directory(name),
+                "data": spec,
+                "backends": backends,
+            }
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(row["directory"].mkdir, parents=True): name
+                for name, row in rows.items()
+            }
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failures[futures[future]] = future.exception()
+                    del rows[futures[future]]
+
+        try:
+            with Project._meta.database.atomic():
+                for batch in chunked(list(rows.values()), BATCH_SIZE):
+                    Project.insert_many(batch).execute()
+        except Exception as error:
+            for name, row in rows.items():
+                shutil.rmtree(row["directory"], ignore_errors=True)
+                failures[name] = error
+            return failures
+
+        created = [
+            obj
+            for batch in chunked(list(rows), BATCH_SIZE)
+            for obj in Project.select().where(Project.name.in_(batch))
+        ]
+        errors = {}
+        for label, backend, objs in self._group_by_backend(created, errors):
+            if not getattr(backend, "__brightway_common_api__", None):
+                continue
+            if hasattr(backend, "create_projects"):
+                try:
+                    _call_hook("create_projects", label, backend, objs)
+                except Exception as error:
+                    errors.update((obj.name, error) for obj in objs)
+                continue
+            for obj in objs:
+                try:
+                    _call_hook("create_project", label, backend, obj, **obj.data)
+                except Exception as error:
+                    errors[obj.name] = error
+        failures.update(errors)
+
+        failed = [obj for obj in created if obj.name in errors]
+        if failed:
+            with Project._meta.database.atomic():
+                for batch in chunked([obj.id for obj in failed], BATCH_SIZE):
+                    Project.delete().where(Project.id.in_(batch)).execute()
+            for obj in failed:
+                shutil.rmtree(obj.directory, ignore_errors=True)
+        return failures
+
+    @mutating
+    @metrics.timed("projects.copy_project")
+    def copy_project(self, new_name, switch=True, default=False, project=None):
+        """Copy ``project`` (default is the current project) to a new project named ``new_name``.
+
+        Files are reflinked or hard linked where possible (see
+        ``filesystem.copy_tree``). The catalog entry and the backends'
+        ``copy_project`` hooks run in one transaction; if any of them fails,
+        the new project and its directory are removed.
+
+        If ``switch``, switch to the new project."""
+        project = self._resolve(project)
+        if new_name in self:
+            raise ValueError("Project {} already exists".format(new_name))
+        dirpath = self.project_directory(new_name)
+        if dirpath.exists():
+            raise ValueError("Project directory already exists")
+
+        with self._acquire(self.lock(project), "copy_project"):
+            try:
+                copy_tree(project.directory, dirpath, ignore=IGNORED_FILES)
+                with Project._meta.database.atomic():
+                    if default:
+                        Project.update(default=False).execute()
+                    obj = Project.create(
+                        name=new_name,
+                        directory=dirpath,
+                        data=project.data,
+                        backends=project.backends,
+                        default=default,
+                    )
+                    for label, backend in obj.backends_items():
+                        if getattr(backend, "__brightway_common_api__", None):
+                            _call_hook("copy_project", label, backend, project, obj)
+            except Exception:
+                shutil.rmtree(dirpath, ignore_errors=True)
+                raise
+
+        if switch:
+            self.select(new_name)
+
+    @metrics.timed("projects.export_project")
+    def export_project(self, project, filepath, compression="gz", since=None):
+        """Export ``project`` (a name or ``Project``) to a tar archive at ``filepath``.
+
+        The archive holds the catalog entry and the project directory, streamed
+        without a temporary copy. ``compression`` is one of ``""``, ``"gz"``,
+        ``"bz2"`` and ``"xz"``.
+
+        If ``since`` is the path of a previous export of this project, the
+        export is differential, and only contains files changed since then.
+        Each export writes a ``<filepath>.manifest.json`` file for this purpose.
+
+        Returns the number of files written."""
+        # Imported here, as ``tarfile`` slows down ``import bw_projects``
+        from .archive import write_archive
+
+        project = self._resolve(project)
+        metadata = {
+            "name": project.name,
+            "data": project.data,
+            "backends": project.backends,
+        }
+        with self._acquire(self.lock(project), "export_project"):
+            count = write_archive(
+                filepath,
+                project.directory,
+                metadata,
+                compression=compression,
+                since=since,
+                ignore=IGNORED_FILES,
+            )
+            for label, backend in project.backends_items():
+                if getattr(backend, "__brightway_common_api__", None):
+                    _call_hook("export_project", label, backend, project, filepath)
+        return count
+
+    @mutating
+    @metrics.timed("projects.import_project")
+    def import_project(self, filepath, name=None, switch=True):
+        """Import a project archive created by ``export_project``.
+
+        The project is created as ``name``, defaulting to its exported name.
+        Differential archives are applied on top of the existing project of that name.
+
+        The catalog entry and the backends' ``import_project`` hooks run in one
+        transaction; if any of them fails, a newly created project and its
+        directory are removed.
+
+        If ``switch``, switch to the imported project."""
+        from .archive import extract_archive, read_metadata
+
+        metadata = read_metadata(filepath)
+        name = name or metadata["name"]
+        if metadata["differential"]:
+            obj = self._resolve(name)
+            extract_archive(filepath, obj.directory)
+            for label, backend in obj.backends_items():
+                if getattr(backend, "__brightway_common_api__", None):
+                    _call_hook("import_project", label, backend, obj, filepath)
+        else:
+            if name in self:
+                raise ValueError("Project {} already exists".format(name))
+            for backend in metadata["backends"]:
+                if backend not in backend_mapping:
+                    raise MissingBackend(f"Backend {backend} missing")
+            dirpath = self.project_directory(name)
+            dirpath.mkdir(parents=True)
+            try:
+                extract_archive(filepath, dirpath)
+                with Project._meta.database.atomic():
+                    obj = Project.create(
+                        name=name,
+                        directory=dirpath,
+                        data=metadata["data"],
+                        backends=metadata["backends"],
+                    )
+                    for label, backend in obj.backends_items():
+                        if getattr(backend, "__brightway_common_api__", None):
+                            _call_hook("import_project", label, backend, obj, filepath)
+            except Exception:
+                shutil.rmtree(dirpath, ignore_errors=True)
+                raise
 
         if switch:
             self.select(name)
 
-    # def copy_project(self, new_name, switch=True, default=False):
-    # Should be defined by backend
-    #     """Copy current project to a new project named ``new_name``. If ``switch``, switch to new project."""
-    #     if new_name in self:
-    #         raise ValueError("Project {} already exists".format(new_name))
-    #     fp = os.path.join(self._base_data_dir, safe_filename(new_name))
-    #     if os.path.exists(fp):
-    #         raise ValueError("Project directory already exists")
-    #     project_data = ProjectDataset.select(ProjectDataset.name == self.current).get().data
-    #     ProjectDataset.create(data=project_data, name=new_name)
-    #     shutil.copytree(self.dir, fp, ignore=lambda x, y: ["write-lock"])
-    #     create_dir(os.path.join(
-    #         self._base_logs_dir,
-    #         safe_filename(new_name)
-    #     ))
-    #     if switch:
-    #         self.set_current(new_name)
+    @property
+    def blob_store(self):
+        """Store of deduplicated files shared by projects; see ``dedupe``."""
+        return BlobStore(self.base_dir / ".blobs")
 
+    @mutating
+    def dedupe(self, names=None, min_size=1, files=()):
+        """Move identical files of projects ``names`` (default is all projects)
+        into the blob store, so that each content is stored only once.
+
+        Only files which are already read-only become hard links into the
+        store; writable files are reflinked where the filesystem supports it,
+        and otherwise left alone (see ``BlobStore``). ``files`` are paths of
+        writable files which backends never modify in place; they are hard
+        linked too, and become read-only. Unused blobs are removed when
+        projects are deleted.
+
+        Returns the number of bytes saved."""
+        store = self.blob_store
+        selected = list(self) if names is None else [self._resolve(x) for x in names]
+        saved = sum(store.add(filepath, hardlink=True) for filepath in files)
+        return saved + sum(
+            store.dedupe(obj.directory, min_size=min_size, ignore=IGNORED_FILES)
+            for obj in selected
+        )
+
+    @mutating
+    @metrics.timed("projects.delete_project")
     def delete_project(self, project):
         """Delete project ``project``.
 
         ``project`` can be a name (sstr) or an instance of ``Project``.
 
-        Set the ``.enabled`` to ``False`` to exclude this project instead of deleting it."""
-        if not isinstance(project, Project):
+        Set the ``.enabled`` to ``False`` to exclude this project instead of deleting it.
+
+        The project directory is moved to the trash and removed by a
+        background thread; see ``purge_trash``.
+
+        Waits up to ``self.lock_timeout`` seconds for other processes using
+        the project to release it, and raises ``LockTimeout`` otherwise."""
+        project = self._resolve(project)
+        self._wait_for_prefetch(project.name)
+
+        with self._exclusive_lock(project, "delete_project"):
+            if project == self.current:
+                self.deactivate()
+
+            for label, backend in project.backends_items():
+                _call_hook("delete_project", label, backend, project)
+
+            project.delete_instance()
+            self._move_to_trash(project.directory)
+        self._delete_manifests(project)
+        self.start_reaper()
+
+    def _delete_manifests(self, project):
+        for manifest in (self.base_dir / ".manifests").glob(
+            "{}.*.json".format(glob.escape(project.directory.name))
+        ):
+            manifest.unlink()
+
+    @property
+    def trash_dir(self):
+        return self.base_dir / TRASH_DIR
+
+    def _move_to_trash(self, directory):
+        """Atomically move ``directory`` into the trash, or remove it right
+        away if it can't be moved."""
+        self.trash_dir.mkdir(exist_ok=True)
+        try:
+            os.replace(
+                directory,
+                self.trash_dir / "{}.{}".format(directory.name, uuid.uuid4().hex),
+            )
+        except OSError:
+            # E.g. open files on Windows
+            shutil.rmtree(directory)
+
+    @mutating
+    @metrics.timed("projects.purge_trash")
+    def purge_trash(self, workers=None):
+        """Remove the directories of deleted projects, and any deduplicated files
+        which are no longer used, in a pool of ``workers`` threads.
+
+        Interrupted purges continue where they stopped.
+
+        Returns the number of directories removed."""
+        with self._purge_lock:
+            if not self.trash_dir.is_dir():
+                return 0
+            entries = [entry.path for entry in os.scandir(self.trash_dir)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Ignore errors; another process could be purging the same trash
+                list(executor.map(lambda x: shutil.rmtree(x, True), entries))
+            store = self.blob_store
+            if store.exists():
+                store.collect()
+            return len(entries)
+
+    def start_reaper(self):
+        """Purge the trash in a background thread, unless one is already running.
+
+        A running reaper purges again if the trash changed since it started."""
+        with self._reaper_lock:
+            self._trash_dirty = True
+            if not self._reaping:
+                self._reaping = True
+                self._reaper = threading.Thread(
+                    target=self._reap, name="bw_projects-reaper", daemon=True
+                )
+                self._reaper.start()
+
+    def _reap(self):
+        while True:
+            with self._reaper_lock:
+                if not self._trash_dirty:
+                    self._reaping = False
+                    return
+                self._trash_dirty = False
             try:
-                project = Project.get(Project.name == project)
-            except DoesNotExist:
-                raise ValueError("{} is not a project".format(project))
+                self.purge_trash()
+            except BaseException:
+                with self._reaper_lock:
+                    self._reaping = False
+                raise
+
+    @mutating
+    @metrics.timed("projects.delete_projects")
+    def delete_projects(self, projects):
+        """Delete many projects at once.
+
+        ``projects`` is an iterable of names or ``Project`` instances. Backends
+        which define ``delete_projects(projects)`` are called once with all
+        their projects; otherwise ``delete_project(project)`` is called for
+        each project. Projects for which a backend is missing or fails are not
+        deleted. The catalog entries of all other projects are removed in one
+        transaction, and their directories moved to the trash, as in
+        ``delete_project``.
 
-        if project == self.current:
+        Projects locked by other processes (see ``lock``) are not deleted.
+
+        Returns a dictionary of ``{name: exception}`` for projects which
+        couldn't be deleted, or whose directory couldn't be removed."""
+        failures, selected, locks = {}, {}, []
+        for project in projects:
+            try:
+                project = self._resolve(project)
+            except ValueError as error:
+                failures[getattr(project, "name", project)] = error
+                continue
+            self._wait_for_prefetch(project.name)
+            try:
+                locks.append(self._exclusive_lock(project, "delete_projects", 0))
+            except LockTimeout as error:
+                failures[project.name] = error
+                continue
+            selected[project.name] = project
+        try:
+            return self._delete_locked(selected, failures)
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _delete_locked(self, selected, failures):
+        if self.current and self.current.name in selected:
             self.deactivate()
 
-        for backend in project.backends_resolved():
-            backend.delete_project(project)
+        for label, backend, objs in self._group_by_backend(
+            selected.values(), failures
+        ):
+            if hasattr(backend, "delete_projects"):
+                try:
+                    _call_hook("delete_projects", label, backend, objs)
+                except Exception as error:
+                    failures.update((obj.name, error) for obj in objs)
+                continue
+            for obj in objs:
+                try:
+                    _call_hook("delete_project", label, backend, obj)
+                except Exception as error:
+                    failures[obj.name] = error
+        deleted = [obj for obj in selected.values() if obj.name not in failures]
+
+        with Project._meta.database.atomic():
+            for batch in chunked([obj.id for obj in deleted], BATCH_SIZE):
+                Project.delete().where(Project.id.in_(batch)).execute()
+
+        for obj in deleted:
+            try:
+                self._move_to_trash(obj.directory)
+                self._delete_manifests(obj)
+            except OSError as error:
+                failures[obj.name] = error
+        self.start_reaper()
+        return failures
+
+    def _group_by_backend(self, objs, failures):
+        """Return ``[(label, backend, [projects using this backend])]``.
+
+        All backends are resolved before any is called; projects with a missing
+        backend are added to ``failures`` and left out of every group."""
+        groups = {}
+        for obj in objs:
+            try:
+                resolved = list(obj.backends_items())
+            except MissingBackend as error:
+                failures[obj.name] = error
+                continue
+            for label, backend in resolved:
+                groups.setdefault(label, (label, backend, []))[2].append(obj)
+        return list(groups.values())
+
+    def _hash_manifest(self, project, algorithm):
+        directory = self.base_dir / ".manifests"
+        if not self.readonly:
+            directory.mkdir(exist_ok=True)
+        return HashManifest(
+            directory / "{}.{}.json".format(project.directory.name, algorithm),
+            algorithm,
+        )
+
+    @mutating
+    def hash_project(self, project=None, algorithm="md5", workers=None):
+        """Record the hashes of all files of ``project`` (default is the current project).
+
+        Hashes are kept in a manifest, so only new or changed files are hashed.
+        ``algorithm`` is one of ``filesystem.HASH_ALGORITHMS``.
+
+        Returns ``{path relative to the project directory: digest}``."""
+        project = self._resolve(project)
+        manifest = self._hash_manifest(project, algorithm)
+        digests = manifest.update(project.directory, IGNORED_FILES, workers)
+        manifest.save()
+        return digests
+
+    def verify_project(self, project=None, algorithm="md5", workers=None, full=False):
+        """Check the files of ``project`` (default is the current project)
+        against the hashes recorded by the last call to ``hash_project``.
 
-        project.delete_instance()
-        shutil.rmtree(project.directory)
+        Only files whose inode, size or modification time changed are hashed,
+        unless ``full``.
 
-    def report(self):
+        Returns a dictionary with lists of ``modified``, ``missing`` and
+        ``added`` files, relative to the project directory."""
+        project = self._resolve(project)
+        manifest = self._hash_manifest(project, algorithm)
+        return manifest.verify(project.directory, IGNORED_FILES, workers, full)
+
+    def _get_size_index(self):
+        filepath = self.base_dir / "dirsizes.json"
+        if self._size_index is None or self._size_index.filepath != filepath:
+            self._size_index = DirectorySizeIndex(filepath)
+        return self._size_index
+
+    def iter_report(self, refresh=False, workers=None, progress=None):
+        """Like ``report``, but yields each ``(project name, backend name, and
+        directory size (GB))`` tuple as soon as its directory has been measured.
+
+        Directories are measured in a pool of ``workers`` threads (default
+        chosen by ``ThreadPoolExecutor``), so results arrive in completion order.
+        ``progress``, if given, is called as ``progress(done, total, row)`` after each project.
+
+        If deleted projects are still waiting to be purged, their size is
+        reported in a row named ``TRASH_LABEL``."""
+        index = self._get_size_index()
+        selected = list(self)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {
+            executor.submit(index.size, obj.directory, refresh): obj for obj in selected
+        }
+        if self.trash_dir.is_dir() and any(os.scandir(self.trash_dir)):
+            futures[executor.submit(index.size, self.trash_dir, refresh)] = None
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                obj = futures[future]
+                if obj is None:
+                    row = (TRASH_LABEL, [], future.result() / 1e9)
+                else:
+                    row = (obj.name, obj.backends, future.result() / 1e9)
+                if progress is not None:
+                    progress(done, len(futures), row)
+                yield row
+            index.retain([obj.directory for obj in selected] + [self.trash_dir])
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+            try:
+                if not self.readonly:
+                    index.save()
+            except OSError:
+                # The index is only a cache
+                pass
+
+    @metrics.timed("projects.report")
+    def report(self, refresh=False, workers=None):
         """Give a report on current projects, backend, and directory sizes.
 
+        Directory sizes come from a persistent index which only rescans
+        directories modified since the last report. Files which grew in place
+        don't modify their directory; use ``refresh="files"`` to check the size
+        of every file, or ``refresh=True`` to rescan everything.
+
         Returns tuples of ``(project name, backend name, and directory size (GB))``."""
-        return sorted([(x.name, x.backends, get_dir_size(x.directory)) for x in self])
+        return sorted(self.iter_report(refresh=refresh, workers=workers))
+
+
+# Project manager of a worker process started by ``ProjectManager.map``
+_map_manager = None
+
+
+def _call_hook(hook, label, backend, *args, **kwargs):
+    """Call ``hook`` on ``backend``, timed as the span ``backend.<hook>.<label>``."""
+    with metrics.span("backend.{}.{}".format(hook, label)):
+        return getattr(backend, hook)(*args, **kwargs)
+
+
+def _init_map_worker(database, base_dir, base_log_dir, lock_timeout):
+    global _map_manager
+    # Imported here; ``urllib.request`` is slow to import
+    from urllib.parse import urlparse
+    from urllib.request import url2pathname
+    import bw_projects
+
+    if database.startswith("file:"):
+        # Our catalog is read-only too
+        database = url2pathname(urlparse(database).path)
+    bw_projects.project_database = SubstitutableDatabase(
+        database, [Project], readonly=True, query_metric="catalog.queries"
+    )
+    _map_manager = ProjectManager(
+        base_dir, base_log_dir, lock_timeout=lock_timeout, readonly=True
+    )
+    # Nothing is selected and activated yet
+    _map_manager.current = None
+    bw_projects.projects = _map_manager
+
+
+def _map_call(func, name):
+    if _map_manager.current is None or _map_manager.current.name != name:
+        _map_manager.select(name)
+    return func(_map_manager.current)
@@ -1,41 +1,99 @@
 # -*- coding: utf-8 -*-
 from . import projects, project_database, backend_mapping
 from pathlib import Path
+import collections
+import itertools
+import os
 import pytest
 import tempfile
+import time
 
 
 class FakeBackend:
+    """Backend which records the projects passed to its hooks.
+
+    ``latency`` makes each hook sleep, to simulate real backends in
+    benchmarks: either a number of seconds for every hook, or a dictionary
+    of ``{hook name: seconds}``."""
+
     __brightway_common_api__ = True
     __brightway_common_api_version__ = 1
     activated = created = copied = None
     deleted = exported = imported = None
+    latency = None
+
+    def __init__(self, latency=None):
+        self.latency = latency
+
+    def _wait(self, hook):
+        if not self.latency:
+            return
+        if isinstance(self.latency, dict):
+            seconds = self.latency.get(hook)
+        else:
+            seconds = self.latency
+        if seconds:
+            time.sleep(seconds)
 
     def activate_project(self, obj):
+        self._wait("activate_project")
         self.activated = obj
 
     def deactivate_project(self):
+        self._wait("deactivate_project")
         self.activated = None
 
-    def create_project(self, obj):
+    def create_project(self, obj, **kwargs):
+        self._wait("create_project")
         self.created = obj
 
     def copy_project(self, old, new):
+        self._wait("copy_project")
         self.copied_old = old
         self.copied_new = new
 
     def delete_project(self, obj):
+        self._wait("delete_project")
         self.deleted = obj
 
     def export_project(self, obj, filepath):
+        self._wait("export_project")
         self.exported = obj
         self.exported_filepath = filepath
 
     def import_project(self, obj, filepath):
+        self._wait("import_project")
         self.imported = obj
         self.imported_filepath = filepath
 
 
+def _isolate(monkeypatch, base_dir, log_dir):
+    """Point ``projects`` at ``base_dir``, with no selected project and fresh caches."""
+    monkeypatch.setattr(projects, "base_dir", base_dir)
+    monkeypatch.setattr(projects, "base_log_dir", log_dir)
+    monkeypatch.setattr(projects, "current", None)
+    monkeypatch.setattr(projects, "_cache", None)
+    monkeypatch.setattr(projects, "_size_index", None)
+    monkeypatch.setattr(projects, "_layout", None)
+    monkeypatch.setattr(projects, "_prefetched", {})
+    monkeypatch.setattr(projects, "_schedule", collections.deque())
+    monkeypatch.setattr(projects, "_held_lock", None)
+    monkeypatch.setattr(projects, "lock_timings", {})
+    monkeypatch.setattr(projects, "backend_timings", {})
+    monkeypatch.setitem(backend_mapping, "tests", FakeBackend())
+
+
+def _teardown():
+    for backend in backend_mapping.loaded().values():
+        backend.deactivate_project()
+    if projects._held_lock is not None:
+        projects._held_lock.release()
+    # Installed entry point backends stay available for the next test
+    for key in backend_mapping.registered():
+        del backend_mapping[key]
+    projects.purge_trash()
+
+
 @pytest.fixture
 def bwtest(monkeypatch):
     with tempfile.TemporaryDirectory() as td:
@@ -43,12 +101,77 @@ def bwtest(monkeypatch):
         project_database._change_path(td / "projects.test.db")
         ld = td / "__logs__"
         ld.mkdir()
-        monkeypatch.setattr(projects, "base_dir", td)
-        monkeypatch.setattr(projects, "base_log_dir", ld)
-        monkeypatch.setattr(projects, "current", None)
-        monkeypatch.setitem(backend_mapping, "tests", FakeBackend())
+        _isolate(monkeypatch, td, ld)
         yield td
-        for key in list(backend_mapping):
-            backend_mapping[key].deactivate_project()
-            del backend_mapping[key]
+        _teardown()
         project_database.close()
+
+
+def _fast_tempdir():
+    """Temporary directory, in memory (``/dev/shm``) where available."""
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return tempfile.TemporaryDirectory(dir=shm)
+    return tempfile.TemporaryDirectory()
+
+
+@pytest.fixture(scope="session")
+def bwtest_session():
+    """Shared state for ``bwtest_fast``: an in-memory catalog, and a
+    temporary directory for project directories."""
+    with _fast_tempdir() as td:
+        td = Path(td)
+        project_database._change_path(":memory:")
+        state = {"db": project_database._db, "root": td, "count": itertools.count()}
+        (td / "done").mkdir()
+        yield state
+        state["db"].close()
+
+
+@pytest.fixture
+def bwtest_fast(bwtest_session, monkeypatch):
+    """Faster replacement for ``bwtest``, for large test suites.
+
+    The catalog is created once per session, in memory, and each test runs
+    inside a ``SAVEPOINT`` which is rolled back afterwards. Each test gets a
+    new, empty base directory, which is moved aside (not deleted) afterwards;
+    all are removed at the end of the session.
+
+    Use both fixtures: ``from bw_projects.testing import bwtest_fast,
+    bwtest_session``. Code under test must not commit: ``projects.map``,
+    and other connections to the catalog, can't see the in-memory catalog."""
+    db = bwtest_session["db"]
+    if project_database._db is not db:
+        # ``bwtest`` switched to another catalog in between, and closed ours
+        project_database._db = db
+        for model in project_database._tables:
+            model.bind(db, bind_refs=False, bind_backrefs=False)
+    if db.is_closed():
+        db.connect()
+        db.create_tables(project_database._tables, safe=True)
+    root = bwtest_session["root"]
+    td = root / str(next(bwtest_session["count"]))
+    ld = td / "__logs__"
+    ld.mkdir(parents=True)
+    _isolate(monkeypatch, td, ld)
+    savepoint = db.savepoint()
+    # Registered like a transaction, so ``atomic()`` blocks nest as savepoints.
+    # Pushed first, and popped last, as peewee < 3.17 commits statements
+    # executed outside a transaction.
+    db.push_transaction(savepoint)
+    try:
+        savepoint.__enter__()
+    except BaseException:
+        db.pop_transaction()
+        raise
+    try:
+        yield td
+        _teardown()
+    finally:
+        # Not ``savepoint.rollback()``, whose arguments differ between peewee versions
+        db.execute_sql("ROLLBACK TO SAVEPOINT {}".format(savepoint.quoted_sid))
+        db.execute_sql("RELEASE SAVEPOINT {}".format(savepoint.quoted_sid))
+        db.pop_transaction()
+        # The rolled back catalog must not be served from the cache
+        projects._cache = None
+        os.rename(td, root / "done" / td.name)
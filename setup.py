@@ -5,6 +5,7 @@ here = path.abspath(path.dirname(__file__))
 
 requirements = [
     'appdirs',
+    'importlib_metadata; python_version < "3.8"',
     'peewee',
 ]
 test_requirements = ['pytest']
@@ -0,0 +1,143 @@
+from bw_projects import backend_mapping, blobs, Project, projects
+from bw_projects.archive import extract_archive, manifest_path, write_archive
+from bw_projects.projects import LOCK_FILE
+from bw_projects.testing import bwtest
+from pathlib import Path
+import io
+import os
+import pytest
+import shutil
+import tarfile
+import tempfile
+
+
+@pytest.fixture
+def source():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "project" / "sub").mkdir(parents=True)
+        (td / "project" / "a").write_text("a")
+        (td / "project" / "sub" / "b").write_text("b")
+        yield td
+
+
+@pytest.mark.parametrize("compression", ["", "gz", "bz2", "xz"])
+def test_archive_roundtrip(source, compression):
+    archive = source / "export.tar"
+    count = write_archive(archive, source / "project", {"name": "foo"}, compression)
+    assert count == 2
+    assert manifest_path(archive).is_file()
+    metadata = extract_archive(archive, source / "copy")
+    assert metadata["name"] == "foo"
+    assert not metadata["differential"]
+    assert (source / "copy" / "sub" / "b").read_text() == "b"
+
+
+def test_archive_roundtrip_links(source):
+    project = source / "project"
+    os.link(project / "a", project / "linked")
+    os.symlink("sub/b", project / "symlink")
+    os.symlink("missing", project / "dangling")
+    write_archive(source / "export.tar", project, {})
+    extract_archive(source / "export.tar", source / "copy")
+    copy = source / "copy"
+    assert (copy / "linked").read_text() == "a"
+    assert os.path.samefile(copy / "a", copy / "linked")
+    assert os.readlink(copy / "symlink") == "sub/b"
+    assert (copy / "symlink").read_text() == "b"
+    assert os.readlink(copy / "dangling") == "missing"
+
+
+def test_archive_invalid_compression(source):
+    with pytest.raises(ValueError):
+        write_archive(source / "export.tar", source / "project", {}, "zip")
+
+
+def test_archive_differential(source):
+    write_archive(source / "full.tar", source / "project", {})
+    extract_archive(source / "full.tar", source / "copy")
+    (source / "project" / "a").unlink()
+    (source / "project" / "c").write_text("c")
+    count = write_archive(
+        source / "diff.tar", source / "project", {}, since=source / "full.tar"
+    )
+    assert count == 1
+    metadata = extract_archive(source / "diff.tar", source / "copy")
+    assert metadata["deleted"] == ["a"]
+    assert sorted(os.listdir(source / "copy")) == ["c", "sub"]
+
+
+def test_archive_rejects_unsafe_members(source):
+    archive = source / "evil.tar"
+    with tarfile.open(archive, "w") as tar:
+        members = (("project.json", b'{"deleted": []}'), ("files/../x", b""))
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    with pytest.raises(ValueError):
+        extract_archive(archive, source / "copy")
+    assert not (source / "x").exists()
+
+
+def test_archive_refuses_writing_through_symlinks(source):
+    (source / "outside").mkdir()
+    (source / "copy").mkdir()
+    os.symlink(source / "outside", source / "copy" / "sub")
+    write_archive(source / "export.tar", source / "project", {})
+    with pytest.raises(ValueError):
+        extract_archive(source / "export.tar", source / "copy")
+    assert not os.listdir(source / "outside")
+
+
+def test_export_import_project(bwtest):
+    backend = backend_mapping["tests"]
+    projects.create_project("foo", backends=["tests"], owner="me")
+    (projects.dir / "data").write_text("data")
+    (projects.dir / "write-lock").touch()
+    archive = bwtest / "foo.tar.gz"
+    assert projects.export_project("foo", archive) == 1
+    assert backend.exported.name == "foo"
+    projects.import_project(archive, name="bar")
+    assert projects.current.name == "bar"
+    assert projects.current.data == {"owner": "me"}
+    assert backend.imported.name == "bar"
+    # Selecting the project created a new lock file
+    assert set(os.listdir(projects.dir)) - {LOCK_FILE} == {"data"}
+    with pytest.raises(ValueError):
+        projects.import_project(archive, name="bar")
+
+
+def test_export_project_without_directory(bwtest):
+    projects.create_project("foo", backends=["tests"], switch=False)
+    shutil.rmtree(Project.get(name="foo").directory)
+    assert projects.export_project("foo", bwtest / "foo.tar") == 0
+    projects.import_project(bwtest / "foo.tar", name="bar")
+    assert set(os.listdir(projects.dir)) == {LOCK_FILE}
+
+
+def test_export_import_deduplicated_project(bwtest, monkeypatch):
+    monkeypatch.setattr(blobs, "reflink", shutil.copyfile)
+    projects.create_project("a", backends=["tests"])
+    for name in ("x", "y"):
+        (projects.dir / name).write_text("same")
+        (projects.dir / name).chmod(0o444)
+    projects.dedupe()
+    projects.export_project("a", bwtest / "a.tar")
+    projects.import_project(bwtest / "a.tar", name="b")
+    assert set(os.listdir(projects.dir)) - {LOCK_FILE} == {"x", "y"}
+    assert (projects.dir / "y").read_text() == "same"
+
+
+def test_import_project_differential(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_text("data")
+    projects.export_project("foo", bwtest / "full.tar")
+    projects.import_project(bwtest / "full.tar", name="bar", switch=False)
+    (projects.dir / "more").write_text("more")
+    count = projects.export_project(
+        "foo", bwtest / "diff.tar", since=bwtest / "full.tar"
+    )
+    assert count == 1
+    projects.import_project(bwtest / "diff.tar", name="bar")
+    assert set(os.listdir(projects.dir)) - {LOCK_FILE} == {"data", "more"}
@@ -0,0 +1,104 @@
+from bw_projects import Project
+from bw_projects.backends import BackendRegistry, find_entry_points
+from bw_projects.errors import MissingBackend
+from bw_projects.testing import bwtest
+from pathlib import Path
+import importlib
+import pytest
+import sys
+import tempfile
+
+GROUP = "bw_projects_tests.backends"
+
+
+@pytest.fixture
+def installed(monkeypatch):
+    """Install a fake distribution advertising backend ``lazy``."""
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "lazy_backend_module.py").write_text(
+            "from bw_projects.testing import FakeBackend\nbackend = FakeBackend()\n"
+        )
+        dist_info = td / "lazy_backend-1.0.dist-info"
+        dist_info.mkdir()
+        (dist_info / "METADATA").write_text(
+            "Metadata-Version: 2.1\nName: lazy-backend\nVersion: 1.0\n"
+        )
+        (dist_info / "entry_points.txt").write_text(
+            "[{}]\nlazy = lazy_backend_module:backend\n".format(GROUP)
+        )
+        monkeypatch.syspath_prepend(str(td))
+        importlib.invalidate_caches()
+        yield
+        sys.modules.pop("lazy_backend_module", None)
+
+
+def test_registry_discovers_without_importing(installed):
+    registry = BackendRegistry(GROUP)
+    assert "lazy" in registry
+    assert list(registry) == ["lazy"]
+    assert "lazy_backend_module" not in sys.modules
+    backend = registry["lazy"]
+    assert "lazy_backend_module" in sys.modules
+    assert registry["lazy"] is backend
+    assert registry.loaded() == {"lazy": backend}
+
+
+def test_find_entry_points_without_importlib_metadata(installed, monkeypatch):
+    # As on Python 3.7 without the ``importlib_metadata`` backport
+    monkeypatch.setitem(sys.modules, "importlib.metadata", None)
+    monkeypatch.setitem(sys.modules, "importlib_metadata", None)
+    monkeypatch.delitem(sys.modules, "pkg_resources", raising=False)
+    assert [ep.name for ep in find_entry_points(GROUP)] == ["lazy"]
+
+
+def test_registry_direct_registration():
+    registry = BackendRegistry(GROUP)
+    registry["direct"] = backend = object()
+    assert registry["direct"] is backend
+    assert len(registry) == 1
+    del registry["direct"]
+    assert "direct" not in registry
+    with pytest.raises(KeyError):
+        registry["direct"]
+    with pytest.raises(KeyError):
+        del registry["direct"]
+
+
+def test_registry_delete_hides_entry_points_until_refresh(installed):
+    registry = BackendRegistry(GROUP)
+    backend = registry["lazy"]
+    del registry["lazy"]
+    assert "lazy" not in registry
+    assert len(registry) == 0
+    assert registry.loaded() == {}
+    with pytest.raises(KeyError):
+        registry["lazy"]
+    with pytest.raises(KeyError):
+        del registry["lazy"]
+    registry["lazy"] = replacement = object()
+    assert registry.registered() == ["lazy"]
+    assert registry["lazy"] is replacement
+    registry.refresh()
+    del registry["lazy"]
+    assert "lazy" not in registry
+    registry.refresh()
+    assert registry["lazy"] is backend
+    assert list(registry) == ["lazy"]
+
+
+def test_registry_clear(installed):
+    registry = BackendRegistry(GROUP)
+    registry["direct"] = object()
+    registry["lazy"]
+    registry.clear()
+    assert len(registry) == 0
+    assert registry.loaded() == {}
+    registry.refresh()
+    assert list(registry) == ["lazy"]
+
+
+def test_missing_backend_resolution(bwtest):
+    obj = Project.create(name="foo", directory=bwtest, backends=["nope"])
+    with pytest.raises(MissingBackend):
+        list(obj.backends_resolved())
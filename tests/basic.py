@@ -1,5 +1,72 @@
 import bw_projects
+import os
+import subprocess
+import sys
+import tempfile
 
 
 def test_version():
     assert bw_projects.__version__
+
+
+def test_import_is_lazy():
+    with tempfile.TemporaryDirectory() as td:
+        env = dict(os.environ, BRIGHTWAY_DIR=td)
+        subprocess.run(
+            [sys.executable, "-c", "import bw_projects"], env=env, check=True
+        )
+        assert not os.listdir(td)
+        subprocess.run(
+            [sys.executable, "-c", "import bw_projects; bw_projects.projects"],
+            env=env,
+            check=True,
+        )
+        assert "projects.db" in os.listdir(td)
+        # Slow imports only needed by some operations
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import bw_projects, sys; bw_projects.projects\n"
+                "print(sorted({'tarfile', 'urllib.request'} & set(sys.modules)))",
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        assert output.splitlines()[-1] == "[]"
+
+
+def test_readonly_environment_variable():
+    script = (
+        "import bw_projects\n"
+        "from bw_projects.errors import ReadOnlyError\n"
+        "print(len(bw_projects.projects), 'foo' in bw_projects.projects)\n"
+        "try:\n"
+        "    bw_projects.projects.create_project('bar')\n"
+        "except ReadOnlyError:\n"
+        "    print('rejected')\n"
+    )
+    with tempfile.TemporaryDirectory() as td:
+        env = dict(os.environ, BRIGHTWAY_DIR=td)
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import bw_projects; bw_projects.projects.create_project('foo', [])",
+            ],
+            env=env,
+            check=True,
+        )
+        os.rmdir(os.path.join(td, "logs"))
+        for flag in ("BRIGHTWAY_READONLY", "BRIGHTWAY_IMMUTABLE"):
+            output = subprocess.run(
+                [sys.executable, "-c", script],
+                env=dict(env, **{flag: "1"}),
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            assert output.splitlines()[-2:] == ["1 True", "rejected"]
+            assert "logs" not in os.listdir(td)
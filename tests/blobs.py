@@ -0,0 +1,130 @@
+from bw_projects import blobs, projects
+from bw_projects.blobs import BlobStore
+from bw_projects.testing import bwtest
+from pathlib import Path
+import os
+import pytest
+import shutil
+import tempfile
+
+
+@pytest.fixture
+def store():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        for name in ("one", "two"):
+            (td / name).mkdir()
+            (td / name / "shared").write_bytes(b"x" * 100)
+            (td / name / "shared").chmod(0o444)
+            (td / name / "unique").write_text(name)
+            (td / name / "unique").chmod(0o444)
+            (td / name / "live").write_bytes(b"y" * 100)
+        yield td, BlobStore(td / "blobs")
+
+
+@pytest.fixture
+def fake_reflink(monkeypatch):
+    def reflink(src, dst):
+        shutil.copyfile(src, dst)
+
+    monkeypatch.setattr(blobs, "reflink", reflink)
+
+
+@pytest.fixture
+def no_reflink(monkeypatch):
+    def reflink(src, dst):
+        raise OSError("Reflinks not supported")
+
+    monkeypatch.setattr(blobs, "reflink", reflink)
+
+
+def test_blob_store_dedupe(store, no_reflink):
+    td, blobs = store
+    assert blobs.dedupe(td / "one") == 0
+    assert blobs.dedupe(td / "two") == 100
+    assert os.path.samefile(td / "one" / "shared", td / "two" / "shared")
+    assert (td / "two" / "shared").read_bytes() == b"x" * 100
+    assert (td / "two" / "unique").read_text() == "two"
+
+
+def test_blob_store_never_links_writable_files(store, no_reflink):
+    td, blobs = store
+    blobs.dedupe(td / "one")
+    blobs.dedupe(td / "two")
+    assert not os.path.samefile(td / "one" / "live", td / "two" / "live")
+    assert (td / "one" / "live").stat().st_mode & 0o200
+    with open(td / "one" / "live", "r+b") as f:
+        f.write(b"z")
+    assert (td / "two" / "live").read_bytes() == b"y" * 100
+
+
+def test_blob_store_reflinks_writable_files(store, fake_reflink):
+    td, blobs = store
+    mtime = (td / "two" / "live").stat().st_mtime_ns
+    assert blobs.dedupe(td / "one") == 0
+    assert blobs.dedupe(td / "two") == 200
+    assert not os.path.samefile(td / "one" / "live", td / "two" / "live")
+    stats = (td / "two" / "live").stat()
+    assert stats.st_mode & 0o200
+    assert stats.st_mtime_ns == mtime
+    with open(td / "one" / "live", "r+b") as f:
+        f.write(b"z")
+    assert (td / "two" / "live").read_bytes() == b"y" * 100
+
+
+def test_blob_store_hardlink_explicit(store):
+    td, blobs = store
+    blobs.add(td / "one" / "live", hardlink=True)
+    assert blobs.add(td / "two" / "live", hardlink=True) == 100
+    assert os.path.samefile(td / "one" / "live", td / "two" / "live")
+    assert not (td / "one" / "live").stat().st_mode & 0o222
+
+
+def test_blob_store_dedupe_idempotent(store, no_reflink):
+    td, blobs = store
+    blobs.dedupe(td / "one")
+    blobs.dedupe(td / "two")
+    assert blobs.dedupe(td / "two") == 0
+
+
+def test_blob_store_collect(store, no_reflink):
+    td, blobs = store
+    blobs.dedupe(td / "one")
+    blobs.dedupe(td / "two")
+    (td / "one" / "shared").unlink()
+    assert blobs.collect() == 0
+    (td / "two" / "shared").unlink()
+    assert blobs.collect() == 100
+    assert blobs.path(blobs.digest(td / "one" / "unique")).exists()
+
+
+def test_projects_dedupe_and_delete(bwtest, no_reflink):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_bytes(b"x" * 1000)
+    (projects.dir / "data").chmod(0o444)
+    (projects.dir / "databases.db").write_bytes(b"y" * 1000)
+    projects.create_project("bar", backends=["tests"])
+    (projects.dir / "data").write_bytes(b"x" * 1000)
+    (projects.dir / "data").chmod(0o444)
+    (projects.dir / "databases.db").write_bytes(b"y" * 1000)
+    assert projects.dedupe() == 1000
+    assert (projects.dir / "databases.db").stat().st_nlink == 1
+    blob = projects.blob_store.path(projects.blob_store.digest(projects.dir / "data"))
+    assert blob.stat().st_nlink == 3
+    projects.delete_project("foo")
+    projects.purge_trash()
+    assert blob.stat().st_nlink == 2
+    projects.delete_project("bar")
+    projects.purge_trash()
+    assert not blob.exists()
+
+
+def test_projects_dedupe_explicit_files(bwtest, no_reflink):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_bytes(b"x" * 1000)
+    first = projects.dir / "data"
+    projects.create_project("bar", backends=["tests"])
+    (projects.dir / "data").write_bytes(b"x" * 1000)
+    assert projects.dedupe() == 0
+    assert projects.dedupe(files=[first, projects.dir / "data"]) == 1000
+    assert os.path.samefile(first, projects.dir / "data")
@@ -0,0 +1,123 @@
+from bw_projects.peewee import ConcurrentSqliteDatabase, SubstitutableDatabase
+from peewee import Model, TextField
+from pathlib import Path
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+
+WORKERS = 4
+ITERATIONS = 10
+
+WORKER_SCRIPT = """
+import sys
+from bw_projects import projects, backend_mapping
+from bw_projects.testing import FakeBackend
+
+backend_mapping["tests"] = FakeBackend()
+worker, iterations = sys.argv[1], int(sys.argv[2])
+for i in range(iterations):
+    name = "{}-{}".format(worker, i)
+    projects.create_project(name, backends=["tests"])
+    assert projects.current.name == name
+    if "shared" in projects:
+        projects.select("shared")
+    len(projects)
+    projects.delete_project(name)
+    assert name not in projects
+projects.create_project("{}-final".format(worker), backends=["tests"])
+"""
+
+
+def test_concurrent_database_wal_mode():
+    class Table(Model):
+        tf = TextField()
+
+    with tempfile.TemporaryDirectory() as td:
+        db = SubstitutableDatabase(Path(td) / "test.db", [Table], concurrent=True)
+        assert isinstance(db._db, ConcurrentSqliteDatabase)
+        assert db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+        db.close()
+
+
+def test_concurrent_database_begins_immediate():
+    class Table(Model):
+        tf = TextField()
+
+    with tempfile.TemporaryDirectory() as td:
+        filepath = Path(td) / "test.db"
+        db = SubstitutableDatabase(filepath, [Table], concurrent=True)
+        with db.atomic():
+            # The write lock is taken before anything is written
+            other = sqlite3.connect(str(filepath), timeout=0)
+            with pytest.raises(sqlite3.OperationalError):
+                other.execute("BEGIN IMMEDIATE")
+            other.close()
+        db.close()
+
+
+def test_concurrent_database_thread_connections():
+    class Table(Model):
+        tf = TextField()
+
+    with tempfile.TemporaryDirectory() as td:
+        db = SubstitutableDatabase(Path(td) / "test.db", [Table], concurrent=True)
+        connections = []
+
+        def work(n):
+            with db.atomic():
+                Table.create(tf=str(n))
+            connections.append(db.connection())
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert Table.select().count() == 8
+        assert len(set(map(id, connections))) == 8
+        db.close()
+
+
+def test_concurrent_processes_stress():
+    with tempfile.TemporaryDirectory() as td:
+        env = dict(os.environ, BRIGHTWAY_DIR=td, BRIGHTWAY_CONCURRENT="1")
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from bw_projects import projects\n"
+                "projects.create_project('shared', backends=[])",
+            ],
+            env=env,
+            check=True,
+        )
+        workers = [
+            subprocess.Popen(
+                [sys.executable, "-c", WORKER_SCRIPT, f"w{n}", str(ITERATIONS)],
+                env=env,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            for n in range(WORKERS)
+        ]
+        for worker in workers:
+            _, stderr = worker.communicate(timeout=120)
+            assert worker.returncode == 0, stderr
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from bw_projects import projects\n"
+                "print(sorted(p.name for p in projects))",
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        expected = sorted(["shared"] + ["w{}-final".format(n) for n in range(WORKERS)])
+        assert output.strip().splitlines()[-1] == str(expected)
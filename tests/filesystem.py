@@ -1,5 +1,23 @@
-from bw_projects.filesystem import safe_filename, get_dir_size, md5
+from bw_projects import filesystem
+from bw_projects.filesystem import (
+    DirectorySizeIndex,
+    FileLock,
+    HashManifest,
+    copy_tree,
+    get_dir_size,
+    hash_file,
+    md5,
+    safe_filename,
+    warm_directory,
+)
+from bw_projects.errors import LockTimeout
 from pathlib import Path
+import hashlib
+import json
+import os
+import pytest
+import shutil
+import tempfile
 
 fixtures_dir = Path(__file__, "..").resolve() / "fixtures"
 
@@ -16,3 +34,211 @@ def test_dir_size():
 def test_safe_filename():
     assert safe_filename("Wave your hand yeah 🙋!") == "Wave-your-hand-yeah.f7952a3d4b0534cdac0e0cbbf66aac73"
     assert safe_filename("Wave your hand yeah 🙋!", add_hash=False) == "Wave-your-hand-yeah"
+
+
+def test_size_index_matches_get_dir_size():
+    index = DirectorySizeIndex()
+    assert index.size(fixtures_dir) == get_dir_size(fixtures_dir) * 1e9
+
+
+def test_size_index_incremental(monkeypatch):
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "sub").mkdir()
+        (td / "sub" / "a").write_bytes(b"x" * 10)
+        (td / "b").write_bytes(b"x" * 5)
+        index = DirectorySizeIndex(td / "index.json")
+        assert index.size(td / "sub") == 10
+
+        scanned = []
+        scandir = os.scandir
+
+        def counting_scandir(path):
+            scanned.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(os, "scandir", counting_scandir)
+        assert index.size(td / "sub") == 10
+        assert not scanned
+
+        (td / "sub" / "c").write_bytes(b"x" * 3)
+        assert index.size(td / "sub") == 13
+        assert scanned == [str(td / "sub")]
+
+
+def test_size_index_files_grown_in_place(monkeypatch):
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "sub").mkdir()
+        (td / "sub" / "a").write_bytes(b"x" * 10)
+        index = DirectorySizeIndex()
+        assert index.size(td) == 10
+        scanned, scandir = [], os.scandir
+
+        def counting_scandir(path):
+            scanned.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(os, "scandir", counting_scandir)
+        with open(td / "sub" / "a", "ab") as f:
+            f.write(b"x" * 1000)
+        assert index.size(td) == 10
+        assert index.size(td, refresh="files") == 1010
+        assert not scanned
+        with pytest.raises(ValueError):
+            index.size(td, refresh="all")
+
+
+def test_size_index_refresh():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "a").write_bytes(b"x" * 10)
+        index = DirectorySizeIndex()
+        assert index.size(td) == 10
+        mtime = os.stat(td).st_mtime_ns
+        (td / "b").write_bytes(b"x" * 20)
+        os.utime(td, ns=(mtime, mtime))
+        assert index.size(td) == 10
+        assert index.size(td, refresh=True) == 30
+
+
+def test_size_index_persistent():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "data").mkdir()
+        (td / "data" / "a").write_bytes(b"x" * 10)
+        index = DirectorySizeIndex(td / "index.json")
+        assert index.size(td / "data") == 10
+        index.save()
+        assert DirectorySizeIndex(td / "index.json")._roots == index._roots
+        # Format without file sizes
+        key = str(td / "data")
+        (td / "index.json").write_text(json.dumps({key: [index._roots[key][0], 5, {}]}))
+        assert DirectorySizeIndex(td / "index.json").size(td / "data") == 10
+
+
+def test_copy_tree():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        src = td / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "a").write_bytes(b"a" * 100)
+        (src / "sub" / "b").write_bytes(b"b" * 250)
+        (src / "write-lock").touch()
+        counts = copy_tree(src, td / "dst", ignore={"write-lock"}, chunk_size=64)
+        assert sum(counts.values()) == 2
+        assert (td / "dst" / "a").read_bytes() == b"a" * 100
+        assert (td / "dst" / "sub" / "b").read_bytes() == b"b" * 250
+        assert not (td / "dst" / "write-lock").exists()
+
+
+def test_copy_tree_hardlinks_immutable_files():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        src = td / "src"
+        src.mkdir()
+        (src / "frozen").write_bytes(b"frozen")
+        (src / "frozen").chmod(0o444)
+        (src / "mutable").write_bytes(b"mutable")
+        counts = copy_tree(src, td / "dst", strategies=("hardlink", "copy"))
+        assert counts == {"hardlink": 1, "copy": 1}
+        assert os.path.samefile(src / "frozen", td / "dst" / "frozen")
+        assert not os.path.samefile(src / "mutable", td / "dst" / "mutable")
+
+
+def test_copy_tree_reflinks_keep_metadata(monkeypatch):
+    # Like a real reflink, the clone gets default mode and times
+    monkeypatch.setattr(filesystem, "reflink", shutil.copyfile)
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        src = td / "src"
+        src.mkdir()
+        (src / "a").write_bytes(b"a")
+        (src / "a").chmod(0o600)
+        os.utime(src / "a", ns=(10**18, 10**18))
+        counts = copy_tree(src, td / "dst")
+        assert counts["reflink"] == 1
+        stats = (td / "dst" / "a").stat()
+        assert stats.st_mtime_ns == 10**18
+        assert stats.st_mode & 0o777 == 0o600
+
+
+def test_hash_file_algorithms():
+    assert hash_file(fixtures_dir / "lorem.txt") == md5(fixtures_dir / "lorem.txt")
+    data = (fixtures_dir / "lorem.txt").read_bytes()
+    for algorithm in ("sha256", "blake2b"):
+        expected = hashlib.new(algorithm, data).hexdigest()
+        assert hash_file(fixtures_dir / "lorem.txt", algorithm) == expected
+
+
+def test_hash_file_mmap(monkeypatch):
+    monkeypatch.setattr(filesystem, "HASH_MMAP_THRESHOLD", 1)
+    assert md5(fixtures_dir / "lorem.txt") == "edc715389af2498a623134608ba0a55b"
+
+
+def test_hash_manifest_incremental(monkeypatch):
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        (td / "data" / "sub").mkdir(parents=True)
+        (td / "data" / "a").write_bytes(b"a")
+        (td / "data" / "sub" / "b").write_bytes(b"b")
+        manifest = HashManifest(td / "manifest.json", "sha256")
+        digests = manifest.update(td / "data")
+        assert digests["sub/b"] == hashlib.sha256(b"b").hexdigest()
+        manifest.save()
+
+        hashed = []
+        original = filesystem.hash_file
+
+        def counting_hash_file(filepath, algorithm):
+            hashed.append(Path(filepath).name)
+            return original(filepath, algorithm)
+
+        monkeypatch.setattr(filesystem, "hash_file", counting_hash_file)
+        manifest = HashManifest(td / "manifest.json", "sha256")
+        (td / "data" / "a").write_bytes(b"changed")
+        (td / "data" / "c").write_bytes(b"c")
+        (td / "data" / "sub" / "b").unlink()
+        assert manifest.verify(td / "data") == {
+            "modified": ["a"],
+            "missing": ["sub/b"],
+            "added": ["c"],
+        }
+        assert hashed == ["a"]
+        manifest.update(td / "data")
+        assert manifest.verify(td / "data") == {
+            "modified": [],
+            "missing": [],
+            "added": [],
+        }
+
+
+def test_hash_manifest_invalid_algorithm():
+    with pytest.raises(ValueError):
+        HashManifest(algorithm="crc32")
+
+
+def test_warm_directory():
+    with tempfile.TemporaryDirectory() as td:
+        (Path(td) / "a").write_bytes(b"x" * 100)
+        (Path(td) / "b").write_bytes(b"x" * 100)
+        assert warm_directory(td) == 200
+        assert warm_directory(td, max_bytes=50) == 100
+
+
+@pytest.mark.skipif(filesystem.fcntl is None, reason="Requires fcntl")
+def test_file_lock():
+    with tempfile.TemporaryDirectory() as td:
+        filepath = Path(td) / "lock"
+        with FileLock(filepath, shared=True), FileLock(filepath, shared=True):
+            with pytest.raises(LockTimeout):
+                FileLock(filepath, timeout=0.05).acquire()
+        with FileLock(filepath, timeout=0) as lock:
+            assert lock.locked
+            with pytest.raises(LockTimeout):
+                FileLock(filepath, shared=True).acquire(timeout=0)
+            lock.acquire(shared=True)
+            with FileLock(filepath, shared=True, timeout=0):
+                pass
+        assert not lock.locked
+        assert lock.waited < 0.05
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from bw_projects import metrics, projects
+from bw_projects.testing import bwtest, FakeBackend
+import pytest
+
+
+@pytest.fixture
+def sink():
+    store = metrics.enable()
+    yield store
+    metrics.disable()
+
+
+def test_disabled_by_default():
+    assert not metrics.enabled()
+    with metrics.span("foo") as span:
+        metrics.count("bar")
+    assert not isinstance(span, metrics.Span)
+
+
+def test_memory_sink(sink):
+    with metrics.span("foo"):
+        pass
+    with metrics.span("foo"):
+        pass
+    metrics.count("bar")
+    metrics.count("bar", 41)
+    summary = sink.summary()["foo"]
+    assert summary["count"] == 2
+    assert 0 <= summary["min"] <= summary["mean"] <= summary["max"]
+    assert sum(sink.histograms["foo"].buckets) == 2
+    assert sink.counters == {"bar": 42}
+    sink.clear()
+    assert not sink.summary() and not sink.counters
+
+
+def test_callback_sink(sink):
+    received = []
+    callback = metrics.CallbackSink(lambda *args: received.append(args))
+    metrics.enable(callback)
+    metrics.count("bar", 2)
+    metrics.observe("foo", 0.5)
+    assert received == [("count", "bar", 2), ("span", "foo", 0.5)]
+    metrics.disable(callback)
+    metrics.count("bar")
+    assert len(received) == 2
+    assert sink.counters == {"bar": 3}
+
+
+def test_timed():
+    @metrics.timed("double")
+    def double(x):
+        return 2 * x
+
+    assert double(2) == 4
+    store = metrics.enable()
+    try:
+        assert double(3) == 6
+    finally:
+        metrics.disable()
+    assert store.summary()["double"]["count"] == 1
+    assert double.__name__ == "double"
+
+
+def test_project_lifecycle_instrumented(bwtest, sink):
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    (projects.dir / "data").write_bytes(b"x" * 100)
+    projects.select("bar")
+    projects.report()
+    projects.deactivate()
+    projects.delete_project("foo")
+    summary = sink.summary()
+    for name in (
+        "projects.create_project",
+        "projects.select",
+        "projects.activate",
+        "projects.deactivate",
+        "projects.report",
+        "projects.delete_project",
+        "backend.activate_project.tests",
+        "backend.deactivate_project.tests",
+        "backend.create_project.tests",
+        "backend.delete_project.tests",
+    ):
+        assert summary[name]["count"] >= 1, name
+    assert sink.counters["catalog.queries"] >= 1
+    assert sink.counters["filesystem.bytes_walked"] >= 100
+
+
+def test_catalog_queries_counted_at_database(bwtest, sink):
+    projects.create_project("foo", backends=["tests"], switch=False)
+    created = sink.counters["catalog.queries"]
+    assert created >= 2
+    repr(projects)
+    assert sink.counters["catalog.queries"] > created
+    counted = sink.counters["catalog.queries"]
+    projects.delete_projects(["foo"])
+    assert sink.counters["catalog.queries"] > counted
+
+
+def test_batch_and_archive_hooks_instrumented(bwtest, sink, tmp_path):
+    projects.create_projects(
+        [{"name": name, "backends": ["tests"]} for name in ("foo", "bar")]
+    )
+    projects.export_project("foo", tmp_path / "foo.tar")
+    projects.import_project(tmp_path / "foo.tar", "baz", switch=False)
+    projects.copy_project("qux", project="foo", switch=False)
+    projects.delete_projects(["foo", "bar"])
+    summary = sink.summary()
+    for hook in (
+        "create_project",
+        "export_project",
+        "import_project",
+        "copy_project",
+        "delete_project",
+    ):
+        assert summary["backend.{}.tests".format(hook)]["count"] >= 1, hook
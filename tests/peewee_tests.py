@@ -1,11 +1,18 @@
+from bw_projects import Project
 from bw_projects.peewee import (
+    JSONCodec,
     JSONField,
+    LazyValue,
+    PackedCodec,
     PathField,
     SubstitutableDatabase,
     TupleField,
 )
-from peewee import Model
+from bw_projects.testing import bwtest
+from peewee import Model, OperationalError
+from playhouse.shortcuts import model_to_dict
 from pathlib import Path
+import json
 import os
 import pytest
 import tempfile
@@ -49,3 +56,116 @@ def test_sd_vacuum():
     db = SubstitutableDatabase(tables=[Table])
     Table.create(jf="late night coding")
     db._vacuum()
+
+
+def test_sd_readonly():
+    class Table(Model):
+        jf = JSONField()
+
+    class Other(Model):
+        jf = JSONField()
+
+    with tempfile.TemporaryDirectory() as td:
+        filepath = Path(td) / "a db"
+        db = SubstitutableDatabase(filepath, tables=[Table])
+        Table.create(jf={"a": 1})
+        db.close()
+
+        for immutable in (False, True):
+            db = SubstitutableDatabase(
+                filepath, tables=[Table, Other], readonly=True, immutable=immutable
+            )
+            assert db.readonly
+            assert Table.get().jf == {"a": 1}
+            assert not Other.table_exists()
+            with pytest.raises(OperationalError):
+                Table.create(jf={"b": 2})
+            db.close()
+
+    with pytest.raises(ValueError):
+        SubstitutableDatabase(tables=[Table], readonly=True)
+
+
+def test_packed_codec_roundtrip():
+    codec = PackedCodec()
+    values = [
+        None,
+        True,
+        False,
+        0,
+        -42,
+        2 ** 80,
+        1.5,
+        "ecoinvent 3.8 ☃",
+        "long" * 100,
+        tuple(range(300)),
+        b"\x00\xff",
+        ("db", "code"),
+        ["list", ("nested", 1)],
+        {"key": [1, 2.5, None]},
+    ]
+    for value in values:
+        encoded = codec.encode(value)
+        assert isinstance(encoded, bytes)
+        assert codec.decode(encoded) == value
+        assert type(codec.decode(encoded)) is type(value)
+
+
+def test_packed_codec_compact():
+    value = ("biosphere3", "1" * 32, 1.2345678901234567, 42)
+    assert len(PackedCodec().encode(value)) < len(JSONCodec().encode(value))
+
+
+def test_packed_codec_reads_json():
+    assert PackedCodec().decode(b'["a", 1]') == ["a", 1]
+
+
+def test_packed_codec_error():
+    with pytest.raises(ValueError):
+        PackedCodec().encode(object())
+
+
+def test_tuplefield_packed_codec():
+    class Table(Model):
+        tf = TupleField(codec=PackedCodec())
+
+    SubstitutableDatabase(tables=[Table])
+    Table.create(tf=["a", 1, ("b", 2.0)])
+    assert Table.get().tf == ("a", 1, ("b", 2.0))
+
+
+def test_lazy_json_field(monkeypatch):
+    class Table(Model):
+        jf = JSONField(lazy=True)
+        tf = TupleField(lazy=True)
+
+    SubstitutableDatabase(tables=[Table])
+    Table.create(jf={"some data": 42}, tf=[1, 2])
+
+    decoded = []
+    loads = json.loads
+
+    def counting_loads(raw):
+        decoded.append(raw)
+        return loads(raw)
+
+    monkeypatch.setattr(json, "loads", counting_loads)
+    obj = Table.get()
+    assert not decoded
+    assert obj.jf == {"some data": 42}
+    assert obj.jf == {"some data": 42}
+    assert len(decoded) == 1
+    obj.save()
+    assert len(decoded) == 1
+    assert Table.get().tf == (1, 2)
+    row = Table.select(Table.jf).dicts().get()
+    assert isinstance(row["jf"], LazyValue)
+    assert row["jf"].value == {"some data": 42}
+
+
+def test_project_fields_decoded_eagerly(bwtest):
+    Project.create(name="foo", directory=bwtest, data={"x": 1}, backends=["tests"])
+    obj = Project.get(name="foo")
+    assert model_to_dict(obj)["data"] == {"x": 1}
+    row = Project.select(Project.data, Project.backends).dicts().get()
+    assert row == {"data": {"x": 1}, "backends": ["tests"]}
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
-from bw_projects import projects, Project, backend_mapping
-from bw_projects.projects import ProjectManager
-from bw_projects.errors import MissingBackend
-from bw_projects.testing import bwtest
+from bw_projects import projects, project_database, Project, backend_mapping
+from bw_projects import filesystem
+from bw_projects.projects import ProjectManager, LOCK_FILE, TRASH_LABEL
+from bw_projects.errors import (
+    ActivationError,
+    LockTimeout,
+    MissingBackend,
+    ReadOnlyError,
+)
+from bw_projects.peewee import SubstitutableDatabase
+from bw_projects.testing import bwtest, FakeBackend
+from concurrent.futures import TimeoutError
+import errno
 import os
 import platform
 import pytest
+import sqlite3
 import tempfile
+import threading
+import time
 
 
 windows = platform.system() == "Windows"
@@ -128,12 +140,121 @@ def test_representation(bwtest):
     assert str(projects)
 
 
+def test_representation_cold_cache(bwtest):
+    for x in range(25):
+        projects.create_project(name=f"project-{x}", backends=["tests"])
+    Project.update(enabled=False).where(Project.name == "project-0").execute()
+    projects._cache = None
+    text = repr(projects)
+    assert projects._cache is None
+    assert text.startswith("Brightway projects manager with 24 objects")
+    assert text.count("\n\tproject-") == 10
+
+
+def test_names(bwtest):
+    for name in ("beta", "Alpha", "alpha-2", "Gamma", "gamma-2"):
+        projects.create_project(name, backends=["tests"])
+    p = Project.get(name="gamma-2")
+    p.enabled = False
+    p.save()
+    assert projects.names() == ["Alpha", "alpha-2", "beta", "Gamma"]
+    assert projects.names(order="created") == ["beta", "Alpha", "alpha-2", "Gamma"]
+    assert projects.names(prefix="AL") == ["Alpha", "alpha-2"]
+    assert projects.names(prefix="g") == ["Gamma"]
+    assert projects.names(prefix="z") == []
+    assert projects.names(limit=2) == ["Alpha", "alpha-2"]
+    assert projects.names(limit=2, offset=2) == ["beta", "Gamma"]
+    assert projects.names(offset=3) == ["Gamma"]
+    with pytest.raises(ValueError):
+        projects.names(order="size")
+
+
+def test_names_uses_index(bwtest):
+    db = Project._meta.database
+    plan = db.execute_sql(
+        "EXPLAIN QUERY PLAN SELECT name FROM project "
+        "WHERE name >= 'a' COLLATE NOCASE ORDER BY name COLLATE NOCASE"
+    ).fetchall()
+    assert "project_name_nocase" in str(plan)
+
+
+def test_filter(bwtest):
+    projects.create_project("a", backends=["tests"], owner="me", year=2020)
+    projects.create_project("b", backends=["tests"], owner="you", year=2020)
+    projects.create_project("c", backends=["tests"], owner="me", info={"tier": 1})
+    projects.create_project("d", backends=["tests"], owner="me", public=True)
+    p = Project.get(name="d")
+    p.enabled = False
+    p.save()
+    names = lambda **kwargs: [obj.name for obj in projects.filter(**kwargs)]
+    assert names(owner="me") == ["a", "c"]
+    assert names(owner="me", year=2020) == ["a"]
+    assert names(year=None) == ["c"]
+    assert names(**{"info.tier": 1}) == ["c"]
+    assert names(owner="nobody") == []
+    assert names(owner="me", page_size=1) == ["a", "c"]
+    assert all(isinstance(obj, Project) for obj in projects.filter(owner="me"))
+    with pytest.raises(ValueError):
+        names(owner=["me"])
+    with pytest.raises(ValueError):
+        names(**{"owner')": "me"})
+
+
+def test_promote_key(bwtest):
+    projects.create_project("a", backends=["tests"], owner="me", info={"tier": 1})
+    projects.create_project("b", backends=["tests"], owner="you")
+    projects.promote_key("owner")
+    projects.promote_key("owner")
+    projects.promote_key("info.tier")
+    assert projects._promoted_columns() == {"meta__owner", "meta__info__tier"}
+    projects.create_project("c", backends=["tests"], owner="me")
+    assert [obj.name for obj in projects.filter(owner="me")] == ["a", "c"]
+    assert [obj.name for obj in projects.filter(**{"info.tier": 1})] == ["a"]
+    assert Project.get(name="c").data == {"owner": "me"}
+
+    plan = Project._meta.database.execute_sql(
+        "EXPLAIN QUERY PLAN SELECT id FROM project WHERE meta__owner = 'me'"
+    ).fetchall()
+    assert "project_meta__owner" in str(plan)
+
+
 def test_contains(bwtest):
     assert "foo" not in projects
     projects.create_project(name="foo", backends=["tests"])
     assert "foo" in projects
 
 
+def test_catalog_cached(bwtest):
+    projects.create_project(name="foo", backends=["tests"])
+    assert projects._catalog() is projects._catalog()
+    assert "foo" in projects
+
+
+def test_catalog_invalidated_by_own_changes(bwtest):
+    projects.create_project(name="foo", backends=["tests"])
+    assert len(projects) == 1
+    p = Project.get(name="foo")
+    p.enabled = False
+    p.save()
+    assert len(projects) == 0
+    assert "foo" in projects
+
+
+def test_catalog_invalidated_by_other_connection(bwtest):
+    projects.create_project(name="foo", backends=["tests"])
+    assert "bar" not in projects
+    connection = sqlite3.connect(str(bwtest / "projects.test.db"))
+    with connection:
+        connection.execute(
+            "INSERT INTO project (data, backends, directory, name, "
+            "\"default\", enabled) VALUES ('{}', '[]', ?, 'bar', 0, 1)",
+            (str(bwtest),),
+        )
+    connection.close()
+    assert "bar" in projects
+    assert len(projects) == 2
+
+
 # .dir
 
 
@@ -162,6 +283,89 @@ def test_select_project_doesnt_exist(bwtest):
     with pytest.raises(ValueError):
         projects.select("foo")
 
+
+def test_fake_backend_latency(bwtest):
+    backend_mapping["slow"] = FakeBackend(latency={"activate_project": 0.05})
+    projects.create_project("foo", backends=["slow"], switch=False)
+    start = time.perf_counter()
+    projects.select("foo")
+    assert time.perf_counter() - start >= 0.05
+
+
+class SwitchingBackend(FakeBackend):
+    def __init__(self):
+        self.calls = []
+
+    def activate_project(self, obj):
+        self.calls.append(("activate", obj.name))
+
+    def deactivate_project(self):
+        self.calls.append(("deactivate",))
+
+    def switch_project(self, old, new):
+        self.calls.append(("switch", old.name, new.name))
+
+
+def test_select_switches_shared_backends(bwtest, monkeypatch):
+    switching = SwitchingBackend()
+    monkeypatch.setitem(backend_mapping, "switching", switching)
+    projects.create_project("foo", backends=["switching", "tests"])
+    projects.create_project("bar", backends=["switching"], switch=False)
+    backend = backend_mapping["tests"]
+    assert backend.activated.name == "foo"
+    projects.select("bar")
+    assert switching.calls == [("activate", "foo"), ("switch", "foo", "bar")]
+    assert not backend.activated
+    assert projects.current.name == "bar"
+    assert "switch_project" in projects.backend_timings
+
+
+def test_select_without_switch_hook(bwtest):
+    backend = backend_mapping["tests"]
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"])
+    assert backend.activated.name == "bar"
+
+
+class PreparingBackend(FakeBackend):
+    def __init__(self):
+        self.prepared = []
+
+    def prepare_project(self, obj):
+        self.prepared.append(obj.name)
+
+
+def test_prefetch(bwtest, monkeypatch):
+    backend = PreparingBackend()
+    monkeypatch.setitem(backend_mapping, "preparing", backend)
+    projects.create_project("foo", backends=["preparing"], switch=False)
+    assert projects.prefetch("foo").result().name == "foo"
+    assert backend.prepared == ["foo"]
+    projects.select("foo")
+    assert backend.activated.name == "foo"
+    assert not projects._prefetched
+
+
+def test_prefetch_missing_project(bwtest):
+    with pytest.raises(ValueError):
+        projects.prefetch("foo")
+
+
+def test_schedule(bwtest, monkeypatch):
+    backend = PreparingBackend()
+    monkeypatch.setitem(backend_mapping, "preparing", backend)
+    for name in ("a", "b", "c"):
+        projects.create_project(name, backends=["preparing"], switch=False)
+    projects.schedule(["a", "b", "c"])
+    projects.select("a")
+    projects._prefetched["b"].result()
+    assert backend.prepared == ["a", "b"]
+    projects.select("b")
+    projects.select("c")
+    assert backend.prepared == ["a", "b", "c"]
+    assert not projects._schedule
+
+
 # .activate, .deactivate
 
 
@@ -177,6 +381,72 @@ def test_activate_deactivate(bwtest):
     assert backend.activated
 
 
+class SlowBackend(FakeBackend):
+    __brightway_concurrent_activation__ = True
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+
+    def activate_project(self, obj):
+        time.sleep(self.delay)
+        super().activate_project(obj)
+
+
+class FailingBackend(FakeBackend):
+    def activate_project(self, obj):
+        raise RuntimeError("failed")
+
+
+def test_activate_concurrent_backends(bwtest, monkeypatch):
+    for label in ("slow-1", "slow-2"):
+        monkeypatch.setitem(backend_mapping, label, SlowBackend())
+    projects.create_project("foo", backends=["slow-1", "slow-2", "tests"])
+    start = time.perf_counter()
+    projects.activate()
+    assert time.perf_counter() - start < 0.35
+    assert backend_mapping["slow-1"].activated.name == "foo"
+    assert backend_mapping["slow-2"].activated.name == "foo"
+    assert set(projects.backend_timings["activate_project"]) == {
+        "slow-1",
+        "slow-2",
+        "tests",
+    }
+
+
+def test_activate_serial_backends_in_order(bwtest, monkeypatch):
+    order = []
+
+    class OrderedBackend(FakeBackend):
+        def __init__(self, label):
+            self.label = label
+
+        def activate_project(self, obj):
+            order.append(self.label)
+
+    for label in "abc":
+        monkeypatch.setitem(backend_mapping, label, OrderedBackend(label))
+    projects.create_project("foo", backends=["c", "a", "b"])
+    assert order == ["c", "a", "b"]
+
+
+def test_activate_timeout(bwtest, monkeypatch):
+    monkeypatch.setitem(backend_mapping, "slow", SlowBackend(delay=0.5))
+    projects.create_project("foo", backends=["slow"], switch=False)
+    projects.current = Project.get(name="foo")
+    with pytest.raises(ActivationError) as error:
+        projects.activate(timeout=0.05)
+    assert isinstance(error.value.errors["slow"], TimeoutError)
+
+
+def test_activate_aggregates_errors(bwtest, monkeypatch):
+    monkeypatch.setitem(backend_mapping, "fail", FailingBackend())
+    projects.create_project("foo", backends=["fail", "tests"], switch=False)
+    with pytest.raises(ActivationError) as error:
+        projects.select("foo")
+    assert list(error.value.errors) == ["fail"]
+    assert backend_mapping["tests"].activated.name == "foo"
+
+
 # .create_project
 
 
@@ -253,6 +523,217 @@ def test_funny_project_names(bwtest):
         assert os.path.isdir(projects.dir)
 
 
+# .copy_project
+
+
+def test_copy_project(bwtest):
+    backend = backend_mapping["tests"]
+    projects.create_project("foo", backends=["tests"], owner="me")
+    (projects.dir / "data.txt").write_text("data")
+    (projects.dir / "write-lock").touch()
+    projects.copy_project("bar", switch=False)
+    assert not (Project.get(name="bar").directory / "write-lock").exists()
+    projects.select("bar")
+    assert projects.current.name == "bar"
+    assert projects.current.data == {"owner": "me"}
+    assert (projects.dir / "data.txt").read_text() == "data"
+    assert backend.copied_old.name == "foo"
+    assert backend.copied_new.name == "bar"
+
+
+def test_copy_project_no_switch(bwtest):
+    projects.create_project("foo", backends=["tests"], switch=False)
+    projects.copy_project("bar", switch=False, project="foo")
+    assert projects.current is None
+    assert "bar" in projects
+
+
+def test_copy_project_already_exists(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    with pytest.raises(ValueError):
+        projects.copy_project("foo")
+
+
+def test_copy_project_backend_error_rolls_back(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"])
+
+    def fail(old, new):
+        raise RuntimeError
+
+    monkeypatch.setattr(backend_mapping["tests"], "copy_project", fail)
+    with pytest.raises(RuntimeError):
+        projects.copy_project("bar")
+    assert "bar" not in projects
+    assert not any(name.startswith("bar.") for name in os.listdir(bwtest))
+
+
+def test_copy_project_copy_error_cleans_up(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_text("data")
+
+    def fail(*args):
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(filesystem, "reflink", fail)
+    monkeypatch.setattr(filesystem, "_copy_range", fail)
+    with pytest.raises(OSError):
+        projects.copy_project("bar")
+    assert "bar" not in projects
+    assert not any(name.startswith("bar.") for name in os.listdir(bwtest))
+
+
+# .hash_project, .verify_project
+
+
+def test_verify_project(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_text("data")
+    digests = projects.hash_project("foo", algorithm="blake2b")
+    assert list(digests) == ["data"]
+    assert projects.verify_project("foo", algorithm="blake2b") == {
+        "modified": [],
+        "missing": [],
+        "added": [],
+    }
+    (projects.dir / "data").write_text("changed")
+    assert projects.verify_project(algorithm="blake2b")["modified"] == ["data"]
+
+
+def test_delete_project_removes_manifest(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    projects.hash_project()
+    assert os.listdir(bwtest / ".manifests")
+    projects.delete_project("foo")
+    assert not os.listdir(bwtest / ".manifests")
+
+
+# .create_projects, .delete_projects
+
+
+class BatchBackend(FakeBackend):
+    def __init__(self):
+        self.batches = []
+
+    def create_projects(self, objs):
+        self.batches.append(("create", sorted(obj.name for obj in objs)))
+
+    def delete_projects(self, objs):
+        self.batches.append(("delete", sorted(obj.name for obj in objs)))
+
+
+def test_create_projects(bwtest, monkeypatch):
+    batch = BatchBackend()
+    monkeypatch.setitem(backend_mapping, "batch", batch)
+    monkeypatch.setitem(backend_mapping, "default", FakeBackend())
+    failures = projects.create_projects(
+        ["a", {"name": "b", "backends": ["batch", "tests"], "owner": "me"}]
+        + [{"name": f"p-{x}", "backends": ["batch"]} for x in range(20)]
+    )
+    assert failures == {}
+    assert len(projects) == 22
+    assert Project.get(name="b").data == {"owner": "me"}
+    assert backend_mapping["tests"].created.name == "b"
+    assert batch.batches == [("create", sorted(["b"] + [f"p-{x}" for x in range(20)]))]
+    assert all(obj.directory.is_dir() for obj in projects)
+    assert projects.current is None
+
+
+def test_create_projects_failures(bwtest, monkeypatch):
+    projects.create_project("a", backends=["tests"])
+
+    def fail(obj, **kwargs):
+        if obj.name == "c":
+            raise RuntimeError
+
+    monkeypatch.setattr(backend_mapping["tests"], "create_project", fail)
+    failures = projects.create_projects(
+        [
+            {"name": "a", "backends": ["tests"]},
+            {"name": "b", "backends": ["tests"]},
+            {"name": "b", "backends": ["tests"]},
+            {"name": "c", "backends": ["tests"]},
+            {"name": "d", "backends": ["nope"]},
+        ]
+    )
+    assert sorted(failures) == ["a", "b", "c", "d"]
+    assert isinstance(failures["c"], RuntimeError)
+    assert isinstance(failures["d"], MissingBackend)
+    assert sorted(obj.name for obj in projects) == ["a", "b"]
+    assert len(os.listdir(bwtest)) == 4
+
+
+def test_delete_projects(bwtest, monkeypatch):
+    batch = BatchBackend()
+    monkeypatch.setitem(backend_mapping, "batch", batch)
+    projects.create_projects(
+        [{"name": x, "backends": ["batch", "tests"]} for x in "abc"]
+    )
+    projects.select("a")
+    directories = [obj.directory for obj in projects]
+    failures = projects.delete_projects(["a", "b", "missing"])
+    assert list(failures) == ["missing"]
+    assert [obj.name for obj in projects] == ["c"]
+    assert projects.current is None
+    assert batch.batches[-1] == ("delete", ["a", "b"])
+    assert backend_mapping["tests"].deleted.name == "b"
+    assert [d.is_dir() for d in directories] == [False, False, True]
+    projects.purge_trash()
+    assert not os.listdir(bwtest / ".trash")
+
+
+def test_delete_projects_backend_failure(bwtest, monkeypatch):
+    projects.create_projects([{"name": x, "backends": ["tests"]} for x in "ab"])
+
+    def fail(obj):
+        if obj.name == "a":
+            raise RuntimeError
+
+    monkeypatch.setattr(backend_mapping["tests"], "delete_project", fail)
+    failures = projects.delete_projects(["a", "b"])
+    assert list(failures) == ["a"]
+    assert [obj.name for obj in projects] == ["a"]
+    assert projects.dir is None
+
+
+def test_delete_projects_missing_backend(bwtest, monkeypatch):
+    batch = BatchBackend()
+    monkeypatch.setitem(backend_mapping, "batch", batch)
+    projects.create_projects(
+        [{"name": x, "backends": ["batch", "tests"]} for x in "ab"]
+    )
+    Project.update(backends=["batch", "gone"]).where(Project.name == "b").execute()
+    failures = projects.delete_projects(["a", "b"])
+    assert list(failures) == ["b"]
+    assert isinstance(failures["b"], MissingBackend)
+    assert batch.batches[-1] == ("delete", ["a"])
+    assert [obj.name for obj in projects] == ["b"]
+
+
+def test_create_projects_backend_removed(bwtest, monkeypatch):
+    batch = BatchBackend()
+    monkeypatch.setitem(backend_mapping, "batch", batch)
+    monkeypatch.setitem(backend_mapping, "gone", FakeBackend())
+    insert_many = Project.insert_many
+
+    def insert_and_remove(rows):
+        # The backend disappears after the checks in ``create_projects``
+        backend_mapping.pop("gone", None)
+        return insert_many(rows)
+
+    monkeypatch.setattr(Project, "insert_many", insert_and_remove)
+    failures = projects.create_projects(
+        [
+            {"name": "a", "backends": ["batch"]},
+            {"name": "b", "backends": ["batch", "gone"]},
+        ]
+    )
+    assert list(failures) == ["b"]
+    assert isinstance(failures["b"], MissingBackend)
+    assert batch.batches == [("create", ["a"])]
+    assert [obj.name for obj in projects] == ["a"]
+    assert not projects.project_directory("b").exists()
+
+
 # .delete_project
 
 
@@ -288,9 +769,254 @@ def test_delete_project_name_string(bwtest):
     assert projects.current is None
 
 
+def test_delete_project_moves_to_trash(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"])
+    directory = projects.dir
+    (directory / "data").write_bytes(b"x" * 1000)
+    monkeypatch.setattr(projects, "start_reaper", lambda: None)
+    projects.delete_project("foo")
+    assert not directory.exists()
+    assert len(os.listdir(bwtest / ".trash")) == 1
+    assert projects.report() == [(TRASH_LABEL, [], 1e-6)]
+    assert projects.purge_trash() == 1
+    assert not os.listdir(bwtest / ".trash")
+    assert projects.report() == []
+
+
+def test_trash_purged_after_restart(bwtest):
+    (bwtest / ".trash" / "leftover" / "sub").mkdir(parents=True)
+    (bwtest / ".trash" / "leftover" / "sub" / "data").write_text("data")
+    manager = ProjectManager(bwtest, bwtest / "__logs__")
+    manager._reaper.join()
+    assert not os.listdir(bwtest / ".trash")
+
+
+def test_reaper_purges_trash_changed_while_running(bwtest, monkeypatch):
+    purge_trash = projects.purge_trash
+    listed, resume = threading.Event(), threading.Event()
+
+    def slow_purge_trash():
+        count = purge_trash()
+        listed.set()
+        resume.wait(5)
+        return count
+
+    monkeypatch.setattr(projects, "purge_trash", slow_purge_trash)
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"])
+    projects.delete_project("foo")
+    assert listed.wait(5)
+    # Moved to the trash after the running reaper listed it
+    projects.delete_project("bar")
+    resume.set()
+    projects._reaper.join(5)
+    assert not os.listdir(bwtest / ".trash")
+
+
+# Locks
+
+needs_fcntl = pytest.mark.skipif(filesystem.fcntl is None, reason="Requires fcntl")
+
+
+@needs_fcntl
+def test_select_holds_shared_lock(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    assert projects._held_lock.filepath == projects.dir / LOCK_FILE
+    with projects.lock("foo", shared=True, timeout=0):
+        with pytest.raises(LockTimeout):
+            projects.lock("foo", shared=False, timeout=0).acquire()
+    projects.select("bar")
+    with projects.lock("foo", shared=False, timeout=0):
+        pass
+    assert "select" in projects.lock_timings
+    projects.deactivate()
+    assert projects._held_lock is None
+
+
+@needs_fcntl
+def test_delete_locked_project(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    monkeypatch.setattr(projects, "lock_timeout", 0.05)
+    # Another process has "foo" selected
+    other = projects.lock("foo", shared=True)
+    with other:
+        with pytest.raises(LockTimeout):
+            projects.delete_project("foo")
+        assert "foo" in projects
+        assert projects.current.name == "foo"
+        assert projects._held_lock.locked
+        with projects.lock("bar", shared=True):
+            failures = projects.delete_projects(["foo", "bar"])
+        assert set(failures) == {"foo", "bar"}
+        assert all(isinstance(error, LockTimeout) for error in failures.values())
+    projects.delete_project("foo")
+    assert "foo" not in projects
+    assert projects.lock_timings["delete_project"] < 0.05
+    assert not projects.delete_projects(["bar"])
+
+
+@needs_fcntl
+def test_copy_waits_for_exclusive_lock(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"], switch=False)
+    monkeypatch.setattr(projects, "lock_timeout", 0.05)
+    with projects.lock("foo", shared=False):
+        with pytest.raises(LockTimeout):
+            projects.copy_project("bar", project="foo")
+        with pytest.raises(LockTimeout):
+            projects.export_project("foo", bwtest / "foo.tar")
+        with pytest.raises(LockTimeout):
+            projects.select("foo")
+    assert "bar" not in projects
+    projects.copy_project("bar", project="foo", switch=False)
+    assert "copy_project" in projects.lock_timings
+
+
+# .map
+
+
+def test_map(bwtest):
+    for name in ("foo", "bar", "baz"):
+        projects.create_project(name, backends=["tests"], switch=False)
+    results = list(projects.map(str, ["foo", "bar", "missing"], workers=2))
+    assert len(results) == 3
+    results = {name: (result, error) for name, result, error in results}
+    assert results["foo"] == ("Project: foo", None)
+    assert results["bar"] == ("Project: bar", None)
+    assert results["missing"][0] is None
+    assert isinstance(results["missing"][1], ValueError)
+    assert projects.current is None
+
+    results = {name: error for name, _, error in projects.map(len, workers=1)}
+    assert set(results) == {"foo", "bar", "baz"}
+    assert all(isinstance(error, TypeError) for error in results.values())
+
+
+# Read-only mode
+
+
+def test_readonly_project_manager(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    db = SubstitutableDatabase(bwtest / "projects.test.db", [Project], readonly=True)
+    try:
+        manager = ProjectManager(bwtest / "ro", bwtest / "ro-logs", readonly=True)
+        assert not (bwtest / "ro").exists()
+        manager.base_dir = bwtest
+        assert sorted(manager.names()) == ["bar", "foo"]
+        manager.select("bar")
+        assert manager.current.name == "bar"
+        assert manager.report()
+        assert manager.verify_project()["added"] == []
+        with pytest.raises(ReadOnlyError):
+            manager.create_project("baz", backends=["tests"])
+        with pytest.raises(ReadOnlyError):
+            manager.copy_project("baz")
+        with pytest.raises(ReadOnlyError):
+            manager.delete_project("foo")
+        with pytest.raises(ReadOnlyError):
+            manager.delete_projects(["foo"])
+        assert "foo" in manager
+        manager.deactivate()
+    finally:
+        db.close()
+        Project.bind(project_database._db, bind_refs=False, bind_backrefs=False)
+
+
+def test_readonly_project_manager_without_lock_file(bwtest, monkeypatch):
+    projects.create_project("foo", backends=["tests"], switch=False)
+    (Project.get(name="foo").directory / "data").write_text("data")
+
+    def read_only(self):
+        raise PermissionError(errno.EACCES, "Read-only", str(self.filepath))
+
+    monkeypatch.setattr(filesystem.FileLock, "_open", read_only)
+    projects.readonly = True
+    try:
+        projects.select("foo")
+        assert not projects._held_lock.locked
+        assert projects.export_project("foo", bwtest / "foo.tar") == 1
+        projects.deactivate()
+    finally:
+        projects.readonly = False
+
+
+# Directory layout
+
+
+def test_sharded_layout(bwtest):
+    projects.migrate_layout("sharded")
+    assert projects.layout == "sharded"
+    assert ProjectManager(bwtest, bwtest / "__logs__").layout == "sharded"
+    projects.create_project("foo", backends=["tests"])
+    assert not projects.create_projects([{"name": "bar", "backends": ["tests"]}])
+    projects.copy_project("baz", project="foo")
+    for name in ("foo", "bar", "baz"):
+        directory = Project.get(name=name).directory
+        digest = directory.name.rsplit(".", 1)[1]
+        assert directory == bwtest / digest[:2] / digest[2:4] / directory.name
+        assert directory.is_dir()
+    with pytest.raises(ValueError):
+        projects.migrate_layout("deep")
+
+
+def test_migrate_layout(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], switch=False)
+    (projects.dir / "data.txt").write_text("data")
+    assert projects.layout == "flat"
+
+    assert projects.migrate_layout("sharded") == 2
+    assert projects.dir == projects.project_directory("foo")
+    assert (projects.dir / "data.txt").read_text() == "data"
+    assert Project.get(name="bar").directory == projects.project_directory("bar")
+    assert projects.migrate_layout("sharded") == 0
+
+    assert projects.migrate_layout("flat") == 2
+    assert (projects.dir / "data.txt").read_text() == "data"
+    assert projects.dir.parent == bwtest
+    assert not [name for name in os.listdir(bwtest) if len(name) == 2]
+
+
+def test_migrate_layout_resumes(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    old = projects.dir
+    new = projects.project_directory("foo", "sharded")
+    # Interrupted after renaming, but before updating the catalog
+    new.parent.mkdir(parents=True)
+    os.rename(old, new)
+    assert projects.migrate_layout("sharded") == 0
+    assert Project.get(name="foo").directory == new
+
+
 # .report
 
 
 def test_project_report(bwtest):
     projects.create_project("foo", backends=["tests"])
     assert projects.report()
+
+
+def test_project_report_uses_size_index(bwtest):
+    projects.create_project("foo", backends=["tests"])
+    (projects.dir / "data").write_bytes(b"x" * 1000)
+    assert projects.report() == [("foo", ["tests"], 1e-6)]
+    assert (bwtest / "dirsizes.json").is_file()
+    assert projects.report(refresh=True) == [("foo", ["tests"], 1e-6)]
+    with open(projects.dir / "data", "ab") as f:
+        f.write(b"x" * 1000)
+    assert projects.report() == [("foo", ["tests"], 1e-6)]
+    assert projects.report(refresh="files") == [("foo", ["tests"], 2e-6)]
+
+
+def test_project_iter_report_progress(bwtest):
+    for name in ("foo", "bar", "baz"):
+        projects.create_project(name, backends=["tests"])
+    calls = []
+    rows = list(
+        projects.iter_report(workers=2, progress=lambda *args: calls.append(args))
+    )
+    assert sorted(rows) == projects.report()
+    assert [(done, total) for done, total, _ in calls] == [(1, 3), (2, 3), (3, 3)]
+    assert sorted(row for _, _, row in calls) == sorted(rows)
@@ -0,0 +1,38 @@
+from bw_projects import projects, Project, backend_mapping
+from bw_projects.testing import bwtest, bwtest_fast, bwtest_session, FakeBackend
+import os
+import pytest
+
+
+def check_isolated(base_dir):
+    assert not len(projects)
+    assert not Project.select().count()
+    assert projects.current is None
+    assert projects.base_dir == base_dir
+    assert list(backend_mapping) == ["tests"]
+
+
+@pytest.mark.parametrize("run", range(2))
+def test_fast_fixture_isolated(bwtest_fast, run):
+    check_isolated(bwtest_fast)
+    assert os.listdir(bwtest_fast) == ["__logs__"]
+    assert not projects._promoted_columns()
+    projects.create_project("foo", backends=["tests"])
+    projects.create_project("bar", backends=["tests"], default=True)
+    projects.promote_key("owner")
+    backend_mapping["other"] = FakeBackend()
+    assert len(projects) == 2
+    assert projects.dir.is_dir()
+
+
+def test_slow_fixture_in_between(bwtest):
+    check_isolated(bwtest)
+    projects.create_project("foo", backends=["tests"])
+
+
+def test_fast_fixture_after_slow_fixture(bwtest_fast):
+    check_isolated(bwtest_fast)
+    assert not projects._promoted_columns()
+    projects.create_project("foo", backends=["tests"])
+    projects.delete_project("foo")
+    assert "foo" not in projects